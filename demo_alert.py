@@ -14,7 +14,7 @@ sys.path.insert(0, os.path.join(os.path.dirname(__file__), 'src'))
 
 from database import db
 from anomaly_detector import AnomalyDetector
-from notifications import slack_notifier
+from notifications import get_slack_notifier
 
 def insert_fake_historical_data():
     """Insert fake historical data to trigger TVL drop alert."""
@@ -23,35 +23,24 @@ def insert_fake_historical_data():
     # Insert a snapshot from 24 hours ago with high TVL
     timestamp_24h_ago = datetime.now(timezone.utc) - timedelta(hours=24)
     
-    with db.get_cursor() as cursor:
-        # Insert high TVL snapshot from 24 hours ago
-        cursor.execute("""
-            INSERT INTO protocol_snapshots 
-            (protocol_name, timestamp, tvl_usd, apy_7d, utilization_rate)
-            VALUES (%s, %s, %s, %s, %s)
-            ON CONFLICT (protocol_name, timestamp) DO NOTHING
-        """, (
+    db.bulk_insert_snapshots([
+        # High TVL snapshot from 24 hours ago
+        (
             'aave-v3',
             timestamp_24h_ago,
             Decimal('50000000000.00'),  # $50 billion
             Decimal('5.00'),
             Decimal('0.75')
-        ))
-        
-        # Insert current snapshot with much lower TVL (30% drop)
-        cursor.execute("""
-            INSERT INTO protocol_snapshots 
-            (protocol_name, timestamp, tvl_usd, apy_7d, utilization_rate)
-            VALUES (%s, %s, %s, %s, %s)
-            ON CONFLICT (protocol_name, timestamp) DO UPDATE
-            SET tvl_usd = EXCLUDED.tvl_usd
-        """, (
+        ),
+        # Current snapshot with much lower TVL (30% drop)
+        (
             'aave-v3',
             datetime.now(timezone.utc),
             Decimal('35000000000.00'),  # $35 billion (30% drop!)
             Decimal('1.50'),  # Low APY
             Decimal('0.97')   # High utilization
-        ))
+        )
+    ], update_existing=True)
     
     print("✅ Fake data inserted successfully!")
     print(f"   - 24h ago: $50B TVL, 5% APY, 75% utilization")
@@ -90,6 +79,7 @@ def test_slack_notification():
     """Test Slack notification."""
     print("\n🔔 Testing Slack notification...")
     
+    slack_notifier = get_slack_notifier()
     if not slack_notifier.enabled:
         print("   ⚠️  Slack webhook not configured")
         print("   Set SLACK_WEBHOOK_URL environment variable to test Slack")
@@ -20,7 +20,7 @@ REM Run tests with coverage
 echo.
 echo [2/2] Running tests with coverage...
 set PYTHONPATH=%CD%\src;%PYTHONPATH%
-pytest tests\ -v --cov=src --cov-report=term-missing --cov-report=html
+pytest tests\ -v -n auto --dist=loadfile --cov=src --cov-report=term-missing --cov-report=html
 if errorlevel 1 (
     echo.
     echo WARNING: Some tests failed
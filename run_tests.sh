@@ -13,7 +13,7 @@ pip install -q -r tests/requirements-test.txt
 # Run tests with coverage
 echo ""
 echo "🔍 Running tests with coverage..."
-pytest tests/ -v --cov=src --cov-report=term-missing --cov-report=html
+pytest tests/ -v -n auto --dist=loadfile --cov=src --cov-report=term-missing --cov-report=html
 
 echo ""
 echo "✅ Test suite complete!"
@@ -0,0 +1,46 @@
+-- Convert an existing unpartitioned protocol_snapshots table into the
+-- monthly range-partitioned layout from sql/schema.sql.
+--
+-- Apply sql/schema.sql first (it defines ensure_snapshot_partitions and
+-- leaves the old table untouched), then run this file once:
+--   psql -U postgres -d protocol_monitor -f sql/migrations/001_partition_protocol_snapshots.sql
+
+BEGIN;
+
+-- Keep the old rows aside and free the names the new table needs
+ALTER TABLE protocol_snapshots RENAME TO protocol_snapshots_unpartitioned;
+ALTER TABLE protocol_snapshots_unpartitioned DROP CONSTRAINT protocol_snapshots_pkey;
+ALTER TABLE protocol_snapshots_unpartitioned DROP CONSTRAINT protocol_snapshots_protocol_name_timestamp_key;
+DROP INDEX IF EXISTS idx_snapshots_proto_ts;
+DROP INDEX IF EXISTS idx_snapshots_protocol_time;
+
+-- Same definition as sql/schema.sql, reusing the existing id sequence
+CREATE TABLE protocol_snapshots (
+    id INTEGER NOT NULL DEFAULT nextval('protocol_snapshots_id_seq'),
+    protocol_name VARCHAR(50) NOT NULL,
+    timestamp TIMESTAMPTZ NOT NULL,
+    tvl_usd DECIMAL(20, 2),
+    apy_7d DECIMAL(8, 4),
+    utilization_rate DECIMAL(5, 4),  -- For lending protocols
+    PRIMARY KEY (id, timestamp),  -- must include the partition key
+    UNIQUE(protocol_name, timestamp)
+) PARTITION BY RANGE (timestamp);
+ALTER SEQUENCE protocol_snapshots_id_seq OWNED BY protocol_snapshots.id;
+
+CREATE INDEX idx_snapshots_proto_ts ON protocol_snapshots(protocol_name, timestamp DESC)
+    INCLUDE (tvl_usd, apy_7d, utilization_rate);
+
+-- Partitions for every month that has data, through the usual lookahead
+SELECT ensure_snapshot_partitions(
+    COALESCE(MIN(timestamp), NOW()) - INTERVAL '1 month',
+    GREATEST(MAX(timestamp), NOW()) + INTERVAL '2 months'
+)
+FROM protocol_snapshots_unpartitioned;
+
+INSERT INTO protocol_snapshots (id, protocol_name, timestamp, tvl_usd, apy_7d, utilization_rate)
+SELECT id, protocol_name, timestamp, tvl_usd, apy_7d, utilization_rate
+FROM protocol_snapshots_unpartitioned;
+
+DROP TABLE protocol_snapshots_unpartitioned;
+
+COMMIT;
@@ -1,15 +1,84 @@
 -- Token Metrics Protocol Monitoring Schema
 
 -- Table for storing protocol snapshots (TVL, APY, utilization)
+-- Range-partitioned by month so time-bounded queries only scan the partitions
+-- they need, and old months can be dropped with DETACH PARTITION instead of
+-- DELETE. Databases created before partitioning are converted by
+-- sql/migrations/001_partition_protocol_snapshots.sql.
 CREATE TABLE IF NOT EXISTS protocol_snapshots (
-    id SERIAL PRIMARY KEY,
+    id SERIAL,
     protocol_name VARCHAR(50) NOT NULL,
     timestamp TIMESTAMPTZ NOT NULL,
     tvl_usd DECIMAL(20, 2),
     apy_7d DECIMAL(8, 4),
     utilization_rate DECIMAL(5, 4),  -- For lending protocols
+    PRIMARY KEY (id, timestamp),  -- must include the partition key
     UNIQUE(protocol_name, timestamp)
-);
+) PARTITION BY RANGE (timestamp);
+
+-- Create the monthly partitions (UTC months) covering [range_start, range_end],
+-- plus a DEFAULT partition for rows outside them. Safe to call repeatedly;
+-- does nothing while protocol_snapshots is still an unpartitioned table.
+-- Postgres refuses to create a partition whose range already has rows in the
+-- DEFAULT partition, so those rows are moved out first and re-inserted into
+-- the new partition, all in the caller's transaction.
+CREATE OR REPLACE FUNCTION ensure_snapshot_partitions(range_start TIMESTAMPTZ, range_end TIMESTAMPTZ)
+RETURNS void AS $$
+DECLARE
+    month_start TIMESTAMP := date_trunc('month', range_start AT TIME ZONE 'UTC');
+    partition_name TEXT;
+    moved_rows BIGINT;
+BEGIN
+    IF NOT EXISTS (
+        SELECT 1 FROM pg_partitioned_table WHERE partrelid = 'protocol_snapshots'::regclass
+    ) THEN
+        RETURN;
+    END IF;
+    
+    WHILE month_start <= range_end AT TIME ZONE 'UTC' LOOP
+        partition_name := 'protocol_snapshots_' || to_char(month_start, 'YYYY_MM');
+        
+        IF to_regclass(partition_name) IS NULL THEN
+            moved_rows := 0;
+            IF to_regclass('protocol_snapshots_default') IS NOT NULL THEN
+                CREATE TEMP TABLE snapshots_moved ON COMMIT DROP AS
+                WITH moved AS (
+                    DELETE FROM protocol_snapshots_default
+                    WHERE timestamp >= month_start AT TIME ZONE 'UTC'
+                    AND timestamp < (month_start + INTERVAL '1 month') AT TIME ZONE 'UTC'
+                    RETURNING *
+                )
+                SELECT * FROM moved;
+                GET DIAGNOSTICS moved_rows = ROW_COUNT;
+            END IF;
+            
+            EXECUTE format(
+                'CREATE TABLE %I PARTITION OF protocol_snapshots FOR VALUES FROM (%L) TO (%L)',
+                partition_name,
+                month_start AT TIME ZONE 'UTC',
+                (month_start + INTERVAL '1 month') AT TIME ZONE 'UTC'
+            );
+            
+            IF to_regclass('pg_temp.snapshots_moved') IS NOT NULL THEN
+                INSERT INTO protocol_snapshots SELECT * FROM snapshots_moved;
+                DROP TABLE snapshots_moved;
+                IF moved_rows > 0 THEN
+                    RAISE NOTICE 'Moved % rows from protocol_snapshots_default into %', moved_rows, partition_name;
+                END IF;
+            END IF;
+        END IF;
+        
+        month_start := month_start + INTERVAL '1 month';
+    END LOOP;
+    
+    CREATE TABLE IF NOT EXISTS protocol_snapshots_default PARTITION OF protocol_snapshots DEFAULT;
+END;
+$$ LANGUAGE plpgsql;
+
+-- The pipeline applies this file on every run, which keeps partitions
+-- created two months ahead of incoming data, so new snapshots should not
+-- land in DEFAULT; any that do are moved once their month is created
+SELECT ensure_snapshot_partitions(NOW() - INTERVAL '1 month', NOW() + INTERVAL '2 months');
 
 -- Table for storing protocol alerts
 CREATE TABLE IF NOT EXISTS protocol_alerts (
@@ -23,6 +92,12 @@ CREATE TABLE IF NOT EXISTS protocol_alerts (
 );
 
 -- Indexes for performance
-CREATE INDEX IF NOT EXISTS idx_snapshots_protocol_time ON protocol_snapshots(protocol_name, timestamp DESC);
+-- Covering index: latest/24h-ago LIMIT 1 lookups are served as index-only scans
+CREATE INDEX IF NOT EXISTS idx_snapshots_proto_ts ON protocol_snapshots(protocol_name, timestamp DESC)
+    INCLUDE (tvl_usd, apy_7d, utilization_rate);
+DROP INDEX IF EXISTS idx_snapshots_protocol_time;  -- superseded by idx_snapshots_proto_ts
 CREATE INDEX IF NOT EXISTS idx_alerts_protocol ON protocol_alerts(protocol_name);
 CREATE INDEX IF NOT EXISTS idx_alerts_status ON protocol_alerts(resolved_at) WHERE resolved_at IS NULL;
+-- Matches the save_alert dedup lookup and open-alert status queries
+CREATE INDEX IF NOT EXISTS idx_alerts_open ON protocol_alerts(protocol_name, alert_type, triggered_at DESC)
+    WHERE resolved_at IS NULL;
@@ -1,71 +1,166 @@
 """Anomaly detection module for protocol monitoring."""
 
 import logging
+import math
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait
+from contextlib import nullcontext
 from datetime import datetime, timedelta, timezone
-from typing import List, Dict, Optional
-from decimal import Decimal
+from typing import List, Dict, Optional, Tuple
 
-from database import db
-from config import ANOMALY_THRESHOLDS, PROTOCOLS
-from notifications import slack_notifier
+from database import db, Snapshot
+from config import ANOMALY_THRESHOLDS, PROTOCOLS, DB_POOL_MAX_CONN, STREAMING_WINDOW_SIZE
+from notifications import get_slack_notifier
 
 logger = logging.getLogger(__name__)
 
+# Sentinel value to distinguish between None and not-provided
+_UNSET = object()
+
+# Slack webhooks are slow (hundreds of ms); send them in the background.
+# Two workers keep bursts well under Slack's webhook rate limit.
+_SLACK_POOL = ThreadPoolExecutor(max_workers=2, thread_name_prefix='slack')
+
+# Alerts raised by StreamingDetector are saved off the ingestion path. One
+# worker keeps saves in the order the alerts were raised.
+_ALERT_POOL = ThreadPoolExecutor(max_workers=1, thread_name_prefix='alerts')
+
+# Metric each rule-based alert type is judged on
+_ALERT_METRICS = {
+    'tvl_drop': 'tvl_usd',
+    'apy_low': 'apy_7d',
+    'utilization_high': 'utilization_pct'
+}
+
+# Samples needed before a rolling z-score is meaningful
+_MIN_ZSCORE_SAMPLES = 10
+
+
+def _borrow_cursor(cursor):
+    """Reuse the caller's cursor if one was passed, otherwise open a new one."""
+    if cursor is not None:
+        return nullcontext(cursor)
+    return db.get_cursor(dict_cursor=False)
+
+
+def _to_snapshot(row) -> Optional[Snapshot]:
+    """Wrap a tuple row from the snapshot statements, passing None through."""
+    return Snapshot._make(row) if row else None
+
+
+def snapshot_from_data(snapshot_data: Dict) -> Snapshot:
+    """Build a detector Snapshot from freshly fetched snapshot data."""
+    def as_float(value):
+        return float(value) if value is not None else None
+    
+    utilization = as_float(snapshot_data.get('utilization_rate'))
+    return Snapshot(
+        protocol_name=snapshot_data['protocol_name'],
+        timestamp=snapshot_data['timestamp'],
+        tvl_usd=as_float(snapshot_data.get('tvl_usd')),
+        apy_7d=as_float(snapshot_data.get('apy_7d')),
+        utilization_pct=utilization * 100 if utilization is not None else None
+    )
+
+
+def _notify_slack(alert_data: Dict):
+    """Send an alert to Slack, logging instead of raising on failure."""
+    try:
+        get_slack_notifier().send_alert(alert_data)
+    except Exception as e:
+        logger.error(f"Failed to send Slack notification: {e}")
+
 
 class AnomalyDetector:
     """Detects anomalies in protocol metrics and triggers alerts."""
     
-    def __init__(self):
+    def __init__(self, batch_notifications: bool = False):
         self.thresholds = ANOMALY_THRESHOLDS
+        # When batching, newly saved alerts wait for flush_notifications()
+        # instead of each posting its own Slack message
+        self.batch_notifications = batch_notifications
+        self._unsent_alerts: List[Dict] = []
     
-    def get_latest_snapshot(self, protocol_name: str) -> Optional[Dict]:
+    def get_latest_snapshot(self, protocol_name: str, cursor=None) -> Optional[Snapshot]:
         """Get the most recent snapshot for a protocol."""
         try:
-            with db.get_cursor() as cursor:
-                cursor.execute("""
-                    SELECT protocol_name, timestamp, tvl_usd, apy_7d, utilization_rate
-                    FROM protocol_snapshots
-                    WHERE protocol_name = %s
-                    ORDER BY timestamp DESC
-                    LIMIT 1
-                """, (protocol_name,))
-                return cursor.fetchone()
+            with _borrow_cursor(cursor) as cursor:
+                cursor.execute("EXECUTE latest_snapshot(%s)", (protocol_name,))
+                return _to_snapshot(cursor.fetchone())
         except Exception as e:
             logger.error(f"Error fetching latest snapshot for {protocol_name}: {e}")
             return None
     
-    def get_snapshot_24h_ago(self, protocol_name: str, current_time: datetime) -> Optional[Dict]:
+    def get_snapshot_24h_ago(self, protocol_name: str, current_time: datetime, cursor=None) -> Optional[Snapshot]:
         """Get snapshot from approximately 24 hours ago."""
         try:
             time_24h_ago = current_time - timedelta(hours=24)
             
-            with db.get_cursor() as cursor:
-                cursor.execute("""
-                    SELECT protocol_name, timestamp, tvl_usd, apy_7d, utilization_rate
-                    FROM protocol_snapshots
-                    WHERE protocol_name = %s
-                    AND timestamp <= %s
-                    ORDER BY timestamp DESC
-                    LIMIT 1
-                """, (protocol_name, time_24h_ago))
-                return cursor.fetchone()
+            with _borrow_cursor(cursor) as cursor:
+                cursor.execute("EXECUTE snapshot_before(%s, %s)", (protocol_name, time_24h_ago))
+                return _to_snapshot(cursor.fetchone())
         except Exception as e:
             logger.error(f"Error fetching 24h snapshot for {protocol_name}: {e}")
             return None
     
-    def check_tvl_drop(self, protocol_name: str) -> Optional[Dict]:
-        """Check if TVL has dropped more than threshold in 24 hours."""
-        latest = self.get_latest_snapshot(protocol_name)
-        if not latest or not latest['tvl_usd']:
+    def get_latest_and_24h(self, protocol_name: str, cursor=None) -> Tuple[Optional[Snapshot], Optional[Snapshot]]:
+        """Get the latest snapshot and the one ~24 hours before it in a single query."""
+        try:
+            with _borrow_cursor(cursor) as cursor:
+                cursor.execute("EXECUTE latest_and_24h(%s)", (protocol_name,))
+                # First column says which snapshot the row is
+                rows = {row[0]: Snapshot._make(row[1:]) for row in cursor.fetchall()}
+                return rows.get('latest'), rows.get('24h')
+        except Exception as e:
+            logger.error(f"Error fetching snapshots for {protocol_name}: {e}")
+            return None, None
+    
+    def get_snapshots_batch(self, protocol_names: List[str], cursor=None) -> Dict[str, Tuple[Snapshot, Optional[Snapshot]]]:
+        """
+        Get latest and ~24h-ago snapshots for many protocols in one query.
+        
+        Returns:
+            Dictionary mapping protocol names to (latest, snapshot_24h);
+            protocols without any snapshot are omitted
+        """
+        try:
+            with _borrow_cursor(cursor) as cursor:
+                # Each row is the latest snapshot followed by the 24h-ago
+                # columns (all NULL when there is no such snapshot)
+                cursor.execute("EXECUTE latest_with_24h(%s)", (protocol_names,))
+                return {
+                    row[0]: (
+                        Snapshot._make(row[:5]),
+                        Snapshot(row[0], *row[5:]) if row[5] is not None else None
+                    )
+                    for row in cursor.fetchall()
+                }
+        except Exception as e:
+            logger.error(f"Error fetching snapshots for {len(protocol_names)} protocols: {e}")
+            return {}
+    
+    def check_tvl_drop(self, protocol_name: str, latest: Optional[Snapshot] = None,
+                       snapshot_24h: Optional[Snapshot] = _UNSET, cursor=None) -> Optional[Dict]:
+        """
+        Check if TVL has dropped more than threshold in 24 hours.
+        
+        Snapshots already fetched by the caller are used as-is; missing ones
+        are queried.
+        """
+        if latest is None:
+            latest, snapshot_24h = self.get_latest_and_24h(protocol_name, cursor=cursor)
+        elif snapshot_24h is _UNSET:
+            snapshot_24h = self.get_snapshot_24h_ago(protocol_name, latest.timestamp, cursor=cursor)
+        
+        if not latest or not latest.tvl_usd:
             return None
         
-        snapshot_24h = self.get_snapshot_24h_ago(protocol_name, latest['timestamp'])
-        if not snapshot_24h or not snapshot_24h['tvl_usd']:
+        if not snapshot_24h or not snapshot_24h.tvl_usd:
             logger.info(f"No 24h historical data for {protocol_name}, skipping TVL drop check")
             return None
         
-        current_tvl = float(latest['tvl_usd'])
-        previous_tvl = float(snapshot_24h['tvl_usd'])
+        current_tvl = latest.tvl_usd
+        previous_tvl = snapshot_24h.tvl_usd
         
         if previous_tvl == 0:
             return None
@@ -83,13 +178,14 @@ class AnomalyDetector:
         
         return None
     
-    def check_apy_low(self, protocol_name: str) -> Optional[Dict]:
+    def check_apy_low(self, protocol_name: str, latest: Optional[Snapshot] = None, cursor=None) -> Optional[Dict]:
         """Check if APY has dropped below threshold."""
-        latest = self.get_latest_snapshot(protocol_name)
-        if not latest or not latest['apy_7d']:
+        if latest is None:
+            latest = self.get_latest_snapshot(protocol_name, cursor=cursor)
+        if not latest or not latest.apy_7d:
             return None
         
-        current_apy = float(latest['apy_7d'])
+        current_apy = latest.apy_7d
         
         if current_apy < self.thresholds['apy_min_percent']:
             return {
@@ -102,17 +198,18 @@ class AnomalyDetector:
         
         return None
     
-    def check_utilization_high(self, protocol_name: str) -> Optional[Dict]:
+    def check_utilization_high(self, protocol_name: str, latest: Optional[Snapshot] = None, cursor=None) -> Optional[Dict]:
         """Check if utilization rate is too high for lending protocols."""
         protocol_config = PROTOCOLS.get(protocol_name)
         if not protocol_config or protocol_config['type'] != 'lending':
             return None
         
-        latest = self.get_latest_snapshot(protocol_name)
-        if not latest or not latest['utilization_rate']:
+        if latest is None:
+            latest = self.get_latest_snapshot(protocol_name, cursor=cursor)
+        if not latest or not latest.utilization_pct:
             return None
         
-        current_utilization = float(latest['utilization_rate']) * 100  # Convert to percentage
+        current_utilization = latest.utilization_pct
         
         if current_utilization > self.thresholds['utilization_max_percent']:
             return {
@@ -125,88 +222,286 @@ class AnomalyDetector:
         
         return None
     
-    def save_alert(self, alert_data: Dict) -> bool:
+    def save_alert(self, alert_data: Dict, cursor=None) -> bool:
         """Save alert to database, avoiding duplicates for recent alerts."""
         try:
-            with db.get_cursor(dict_cursor=False) as cursor:
-                # Check if similar alert exists in last hour (unresolved)
-                cursor.execute("""
-                    SELECT id FROM protocol_alerts
-                    WHERE protocol_name = %s
-                    AND alert_type = %s
-                    AND resolved_at IS NULL
-                    AND triggered_at > NOW() - INTERVAL '1 hour'
-                    LIMIT 1
-                """, (alert_data['protocol_name'], alert_data['alert_type']))
+            with _borrow_cursor(cursor) as cursor:
+                # Insert unless a similar alert is open from the last hour;
+                # dedup and write happen in one statement
+                cursor.execute(
+                    "EXECUTE insert_alert_if_new(%(protocol_name)s, %(alert_type)s, %(severity)s, %(message)s, %(triggered_at)s)",
+                    alert_data
+                )
                 
-                if cursor.fetchone():
+                if cursor.rowcount != 1:
                     logger.info(f"Similar alert already exists for {alert_data['protocol_name']} - {alert_data['alert_type']}")
                     return False
                 
-                # Insert new alert
-                cursor.execute("""
-                    INSERT INTO protocol_alerts 
-                    (protocol_name, alert_type, severity, message, triggered_at)
-                    VALUES (%(protocol_name)s, %(alert_type)s, %(severity)s, %(message)s, %(triggered_at)s)
-                """, alert_data)
-                
                 logger.warning(f"ALERT: {alert_data['severity'].upper()} - {alert_data['message']}")
                 
-                # Send Slack notification
-                try:
-                    slack_notifier.send_alert(alert_data)
-                except Exception as e:
-                    logger.error(f"Failed to send Slack notification: {e}")
-                
-                return True
-                
         except Exception as e:
             logger.error(f"Failed to save alert: {e}")
             return False
+        
+        if self.batch_notifications:
+            self._unsent_alerts.append(alert_data)
+        else:
+            # Send Slack notification in the background once the alert is
+            # written, so a slow webhook never holds the cursor open
+            _SLACK_POOL.submit(_notify_slack, alert_data)
+        
+        return True
     
-    def detect_anomalies(self, protocol_name: str) -> List[Dict]:
-        """Run all anomaly checks for a protocol."""
+    def flush_notifications(self):
+        """Send every alert saved since the last flush in one batched Slack message."""
+        unsent, self._unsent_alerts = self._unsent_alerts, []
+        if not unsent:
+            return
+        
+        try:
+            get_slack_notifier().send_alerts(unsent)
+        except Exception as e:
+            logger.error(f"Failed to send Slack notifications: {e}")
+    
+    def detect_anomalies(self, protocol_name: str, latest: Optional[Snapshot] = None,
+                         snapshot_24h: Optional[Snapshot] = _UNSET, cursor=None) -> List[Dict]:
+        """
+        Run all anomaly checks for a protocol.
+        
+        Every query runs on a single connection. Pass `cursor` to reuse one
+        the caller already holds; otherwise a session is opened for this call.
+        Snapshots the caller already fetched (see get_snapshots_batch) skip
+        the lookup queries.
+        """
+        if cursor is None:
+            with db.session() as conn, db.get_cursor(dict_cursor=False, connection=conn) as cursor:
+                return self.detect_anomalies(protocol_name, latest, snapshot_24h, cursor=cursor)
+        
         alerts = []
         
+        # Fetch snapshots once and share them across all checks
+        if latest is None:
+            latest, snapshot_24h = self.get_latest_and_24h(protocol_name, cursor=cursor)
+        if not latest:
+            logger.info(f"No snapshot data for {protocol_name}, skipping anomaly checks")
+            return alerts
+        
         # Check TVL drop
-        tvl_alert = self.check_tvl_drop(protocol_name)
+        tvl_alert = self.check_tvl_drop(protocol_name, latest=latest, snapshot_24h=snapshot_24h, cursor=cursor)
         if tvl_alert:
             alerts.append(tvl_alert)
-            self.save_alert(tvl_alert)
+            self.save_alert(tvl_alert, cursor=cursor)
         
         # Check APY low
-        apy_alert = self.check_apy_low(protocol_name)
+        apy_alert = self.check_apy_low(protocol_name, latest=latest)
         if apy_alert:
             alerts.append(apy_alert)
-            self.save_alert(apy_alert)
+            self.save_alert(apy_alert, cursor=cursor)
         
         # Check utilization high
-        util_alert = self.check_utilization_high(protocol_name)
+        util_alert = self.check_utilization_high(protocol_name, latest=latest)
         if util_alert:
             alerts.append(util_alert)
-            self.save_alert(util_alert)
+            self.save_alert(util_alert, cursor=cursor)
         
         return alerts
     
+    def _detect_protocol(self, protocol_name: str, snapshots: Dict[str, Tuple[Snapshot, Optional[Snapshot]]]) -> List[Dict]:
+        """Run detection for one protocol of a sweep, logging instead of raising."""
+        try:
+            if protocol_name not in snapshots:
+                logger.info(f"No snapshot data for {protocol_name}, skipping anomaly checks")
+                return []
+            
+            latest, snapshot_24h = snapshots[protocol_name]
+            alerts = self.detect_anomalies(protocol_name, latest=latest, snapshot_24h=snapshot_24h)
+            
+            if alerts:
+                logger.warning(f"Detected {len(alerts)} anomalies for {protocol_name}")
+            else:
+                logger.info(f"No anomalies detected for {protocol_name}")
+            
+            return alerts
+            
+        except Exception as e:
+            logger.error(f"Error detecting anomalies for {protocol_name}: {e}", exc_info=True)
+            return []
+    
+    def detect_anomalies_batch(self, snapshots: Dict[str, Tuple[Snapshot, Optional[Snapshot]]],
+                               protocol_names: Optional[List[str]] = None) -> Dict[str, List[Dict]]:
+        """
+        Run detection for many protocols from snapshots already fetched by
+        get_snapshots_batch.
+        
+        Protocols are checked concurrently; each worker borrows its own
+        pooled connection for saving alerts. `protocol_names` (default: the
+        protocols in `snapshots`) sets which protocols are reported.
+        """
+        if protocol_names is None:
+            protocol_names = list(snapshots)
+        if not protocol_names:
+            return {}
+        
+        max_workers = min(len(protocol_names), DB_POOL_MAX_CONN)
+        with ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='detect') as executor:
+            results = executor.map(lambda name: self._detect_protocol(name, snapshots), protocol_names)
+            return dict(zip(protocol_names, results))
+    
     def detect_all_protocols(self) -> Dict[str, List[Dict]]:
-        """Run anomaly detection for all protocols."""
-        all_alerts = {}
+        """
+        Run anomaly detection for all protocols.
         
-        for protocol_name in PROTOCOLS.keys():
-            try:
-                alerts = self.detect_anomalies(protocol_name)
-                all_alerts[protocol_name] = alerts
-                
-                if alerts:
-                    logger.warning(f"Detected {len(alerts)} anomalies for {protocol_name}")
-                else:
-                    logger.info(f"No anomalies detected for {protocol_name}")
-                    
-            except Exception as e:
-                logger.error(f"Error detecting anomalies for {protocol_name}: {e}", exc_info=True)
-                all_alerts[protocol_name] = []
-        
-        return all_alerts
+        Snapshots for every protocol are loaded in one query, then checked
+        with detect_anomalies_batch.
+        """
+        protocol_names = list(PROTOCOLS.keys())
+        return self.detect_anomalies_batch(self.get_snapshots_batch(protocol_names), protocol_names)
+
+
+class _RollingStats:
+    """Mean and variance of the last `size` values, updated in O(1) per value."""
+    
+    def __init__(self, size: int):
+        self.values = deque(maxlen=size)
+        self.mean = 0.0
+        self._m2 = 0.0  # sum of squared deviations from the mean (Welford)
+    
+    def add(self, value: float):
+        if len(self.values) == self.values.maxlen:
+            # Sliding Welford update: replace the oldest value with the new one
+            oldest = self.values[0]
+            self.values.append(value)
+            previous_mean = self.mean
+            self.mean += (value - oldest) / len(self.values)
+            self._m2 += (value - oldest) * (value - self.mean + oldest - previous_mean)
+        else:
+            self.values.append(value)
+            delta = value - self.mean
+            self.mean += delta / len(self.values)
+            self._m2 += delta * (value - self.mean)
+    
+    def zscore(self, value: float) -> Optional[float]:
+        """Standard score of `value` against the window, or None without a usable baseline."""
+        count = len(self.values)
+        if count < _MIN_ZSCORE_SAMPLES:
+            return None
+        
+        variance = max(self._m2, 0.0) / (count - 1)
+        if variance == 0:
+            return None
+        
+        return (value - self.mean) / math.sqrt(variance)
+
+
+class _ProtocolWindow:
+    """In-memory history for one protocol."""
+    
+    def __init__(self, size: int):
+        # Snapshots covering the last 24 hours plus the newest one before that
+        self.history = deque()
+        self.stats = {metric: _RollingStats(size) for metric in _ALERT_METRICS.values()}
+    
+    def record(self, snapshot: Snapshot):
+        self.history.append(snapshot)
+        
+        cutoff = snapshot.timestamp - timedelta(hours=24)
+        while len(self.history) > 1 and self.history[1].timestamp <= cutoff:
+            self.history.popleft()
+        
+        for metric, stats in self.stats.items():
+            value = getattr(snapshot, metric)
+            if value is not None:
+                stats.add(value)
+    
+    def snapshot_24h_before(self, timestamp: datetime) -> Optional[Snapshot]:
+        oldest = self.history[0] if self.history else None
+        if oldest and oldest.timestamp <= timestamp - timedelta(hours=24):
+            return oldest
+        return None
+
+
+class StreamingDetector:
+    """
+    Push-based anomaly detection over in-memory rolling windows.
+    
+    Feed each snapshot to update() as it is ingested. The rule checks run
+    against cached history instead of querying the database, and rule alerts
+    whose metric is also an outlier against the rolling window (z-score
+    beyond the 'zscore_escalate' threshold) are escalated to critical.
+    A protocol's window is warm-started from the database the first time it
+    is seen.
+    """
+    
+    def __init__(self, detector: Optional[AnomalyDetector] = None, window_size: int = STREAMING_WINDOW_SIZE):
+        self.detector = detector or AnomalyDetector()
+        self.window_size = window_size
+        self._windows: Dict[str, _ProtocolWindow] = {}
+        self._pending_saves = []
+    
+    def has_window(self, protocol_name: str) -> bool:
+        """Whether `protocol_name` already has a rolling window loaded."""
+        return protocol_name in self._windows
+    
+    def warm_start(self, protocol_names: List[str], before: Optional[datetime] = None):
+        """Load the last 24 hours of snapshots before `before` (default now) in one query."""
+        before = before or datetime.now(timezone.utc)
+        windows = {name: _ProtocolWindow(self.window_size) for name in protocol_names}
+        
+        try:
+            with db.get_cursor(dict_cursor=False) as cursor:
+                cursor.execute("EXECUTE snapshot_windows(%s, %s)", (protocol_names, before))
+                for row in cursor.fetchall():
+                    windows[row[0]].record(Snapshot._make(row))
+        except Exception as e:
+            # Start from empty windows; history builds up from new snapshots
+            logger.error(f"Error warm-starting windows for {protocol_names}: {e}")
+        
+        self._windows.update(windows)
+    
+    def update(self, snapshot: Snapshot) -> List[Dict]:
+        """
+        Check a newly ingested snapshot and queue its alerts for saving.
+        
+        Returns:
+            Alerts raised for the snapshot
+        """
+        protocol_name = snapshot.protocol_name
+        if protocol_name not in self._windows:
+            self.warm_start([protocol_name], before=snapshot.timestamp)
+        window = self._windows[protocol_name]
+        
+        # Score against the baseline before the new values join it
+        zscores = {
+            metric: stats.zscore(getattr(snapshot, metric))
+            for metric, stats in window.stats.items()
+            if getattr(snapshot, metric) is not None
+        }
+        window.record(snapshot)
+        
+        candidates = (
+            self.detector.check_tvl_drop(
+                protocol_name, latest=snapshot,
+                snapshot_24h=window.snapshot_24h_before(snapshot.timestamp)
+            ),
+            self.detector.check_apy_low(protocol_name, latest=snapshot),
+            self.detector.check_utilization_high(protocol_name, latest=snapshot)
+        )
+        alerts = [alert for alert in candidates if alert]
+        
+        for alert in alerts:
+            zscore = zscores.get(_ALERT_METRICS[alert['alert_type']])
+            if zscore is not None and abs(zscore) > self.detector.thresholds['zscore_escalate']:
+                alert['severity'] = 'critical'
+                alert['message'] += f" ({zscore:+.1f}σ from the {self.window_size}-sample rolling mean)"
+            
+            self._pending_saves.append(_ALERT_POOL.submit(self.detector.save_alert, alert))
+        
+        return alerts
+    
+    def flush(self):
+        """Wait until every queued alert has been saved."""
+        pending, self._pending_saves = self._pending_saves, []
+        wait(pending)
 
 
 def run_anomaly_detection():
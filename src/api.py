@@ -1,67 +1,86 @@
 """FastAPI health endpoint for protocol monitoring."""
 
 from fastapi import FastAPI, HTTPException, Query
-from fastapi.responses import JSONResponse
+from fastapi.responses import ORJSONResponse, Response
 from typing import List, Dict, Optional
 from datetime import datetime, timedelta, timezone
 from decimal import Decimal
 import logging
+import threading
+import time
+import orjson
 
 from database import db
-from config import PROTOCOLS
+from config import PROTOCOLS, PROTOCOLS_CACHE_TTL, HISTORY_FETCH_SIZE
 
 logger = logging.getLogger(__name__)
 
+
+def _json_default(obj):
+    """Serialize values orjson does not support natively."""
+    if isinstance(obj, Decimal):
+        return float(obj)
+    raise TypeError(f"Type is not JSON serializable: {type(obj).__name__}")
+
+
+class MonitorJSONResponse(ORJSONResponse):
+    """orjson-encoded JSON response that also serializes Decimal values."""
+    
+    def render(self, content) -> bytes:
+        return orjson.dumps(content, default=_json_default, option=orjson.OPT_NAIVE_UTC)
+
+
 app = FastAPI(
     title="Protocol Monitor API",
     description="Health monitoring API for DeFi protocols",
-    version="1.0.0"
+    version="1.0.0",
+    default_response_class=MonitorJSONResponse
 )
 
+# Endpoints that query Postgres are plain `def` functions: FastAPI runs them
+# in its worker threadpool, so blocking psycopg2 calls (served from the shared
+# connection pool) never stall the event loop. Handlers that return rows
+# build MonitorJSONResponse themselves, which skips FastAPI's
+# jsonable_encoder pass over the payload.
 
-def decimal_to_float(obj):
-    """Convert Decimal objects to float for JSON serialization."""
-    if isinstance(obj, Decimal):
-        return float(obj)
-    elif isinstance(obj, dict):
-        return {k: decimal_to_float(v) for k, v in obj.items()}
-    elif isinstance(obj, list):
-        return [decimal_to_float(item) for item in obj]
-    return obj
 
+# Last /protocols payload, when it expires and, while it is being reloaded,
+# an Event set when the load finishes. Dashboards poll far more often than
+# snapshots change, so requests within the TTL share one result.
+_protocols_cache = {}
+_protocols_cache_lock = threading.Lock()
 
-def determine_protocol_status(protocol_name: str) -> str:
-    """Determine protocol health status based on recent alerts."""
+
+# Alert severities that affect protocol status; anything else is healthy
+_STATUS_BY_SEVERITY = {
+    'critical': 'critical',
+    'warning': 'warning'
+}
+
+
+def determine_protocol_statuses(protocol_names: List[str]) -> Dict[str, str]:
+    """Determine health status for several protocols from recent alerts in one query."""
     try:
-        with db.get_cursor() as cursor:
-            # Check for critical alerts in last 24 hours
-            cursor.execute("""
-                SELECT severity FROM protocol_alerts
-                WHERE protocol_name = %s
-                AND resolved_at IS NULL
-                AND triggered_at > NOW() - INTERVAL '24 hours'
-                ORDER BY 
-                    CASE severity
-                        WHEN 'critical' THEN 1
-                        WHEN 'warning' THEN 2
-                        WHEN 'info' THEN 3
-                    END
-                LIMIT 1
-            """, (protocol_name,))
+        with db.get_cursor(dict_cursor=False) as cursor:
+            # Most severe open alert in the last 24 hours per protocol,
+            # as (protocol_name, severity) rows
+            cursor.execute("EXECUTE protocol_statuses(%s)", (protocol_names,))
             
-            result = cursor.fetchone()
-            if result:
-                severity = result['severity']
-                if severity == 'critical':
-                    return 'critical'
-                elif severity == 'warning':
-                    return 'warning'
-            
-            return 'healthy'
+            severities = dict(cursor.fetchall())
+        
+        return {
+            name: _STATUS_BY_SEVERITY.get(severities.get(name), 'healthy')
+            for name in protocol_names
+        }
             
     except Exception as e:
-        logger.error(f"Error determining status for {protocol_name}: {e}")
-        return 'unknown'
+        logger.error(f"Error determining status for {protocol_names}: {e}")
+        return {name: 'unknown' for name in protocol_names}
+
+
+def determine_protocol_status(protocol_name: str) -> str:
+    """Determine protocol health status based on recent alerts."""
+    return determine_protocol_statuses([protocol_name])[protocol_name]
 
 
 @app.get("/")
@@ -78,60 +97,148 @@ async def root():
     }
 
 
+def _load_protocols() -> List[Dict]:
+    """Build the /protocols payload from the latest snapshots and alert statuses."""
+    protocol_names = list(PROTOCOLS.keys())
+    
+    # Plain tuples in protocol_overview column order; only the fields the
+    # payload uses are selected
+    with db.get_cursor(dict_cursor=False) as cursor:
+        cursor.execute("EXECUTE protocol_overview(%s)", (protocol_names,))
+        
+        snapshots = {row[0]: row for row in cursor.fetchall()}
+    
+    statuses = determine_protocol_statuses(list(snapshots.keys())) if snapshots else {}
+    
+    protocols_data = []
+    
+    for protocol_name in protocol_names:
+        snapshot = snapshots.get(protocol_name)
+        
+        if snapshot:
+            _, timestamp, tvl, apy, utilization = snapshot
+            protocol_info = {
+                'name': protocol_name,
+                'tvl': tvl,
+                'apy': apy,
+                'utilization': utilization,
+                'status': statuses[protocol_name],
+                'last_updated': timestamp
+            }
+            protocols_data.append(protocol_info)
+        else:
+            protocols_data.append({
+                'name': protocol_name,
+                'tvl': None,
+                'apy': None,
+                'utilization': None,
+                'status': 'unknown',
+                'last_updated': None
+            })
+    
+    return protocols_data
+
+
+def _cached_protocols() -> List[Dict]:
+    """
+    Return the /protocols payload, reloading it at most once per TTL.
+    
+    The first request after expiry runs the query, outside the lock.
+    Requests arriving meanwhile get the previous payload if there is one,
+    otherwise they wait for that single load instead of querying too.
+    """
+    with _protocols_cache_lock:
+        if _protocols_cache.get('expires_at', 0) > time.monotonic():
+            return _protocols_cache['data']
+        
+        in_flight = _protocols_cache.get('loading')
+        if in_flight is None:
+            in_flight = _protocols_cache['loading'] = threading.Event()
+            is_loader = True
+        elif 'data' in _protocols_cache:
+            # Serve the stale payload while another request reloads it
+            return _protocols_cache['data']
+        else:
+            is_loader = False
+    
+    if not is_loader:
+        in_flight.wait()
+        with _protocols_cache_lock:
+            if 'data' in _protocols_cache:
+                return _protocols_cache['data']
+        raise RuntimeError("Concurrent /protocols load failed")
+    
+    try:
+        protocols_data = _load_protocols()
+        with _protocols_cache_lock:
+            _protocols_cache['data'] = protocols_data
+            _protocols_cache['expires_at'] = time.monotonic() + PROTOCOLS_CACHE_TTL
+        return protocols_data
+    finally:
+        with _protocols_cache_lock:
+            _protocols_cache.pop('loading', None)
+        in_flight.set()
+
+
 @app.get("/protocols")
-async def get_protocols():
+def get_protocols():
     """
     Get current status of all monitored protocols.
     
+    Results are cached for PROTOCOLS_CACHE_TTL seconds.
+    
     Returns:
         List of protocols with name, tvl, apy, and health status
     """
     try:
-        protocols_data = []
+        protocols_data = _cached_protocols()
         
-        for protocol_name in PROTOCOLS.keys():
-            with db.get_cursor() as cursor:
-                cursor.execute("""
-                    SELECT protocol_name, tvl_usd, apy_7d, utilization_rate, timestamp
-                    FROM protocol_snapshots
-                    WHERE protocol_name = %s
-                    ORDER BY timestamp DESC
-                    LIMIT 1
-                """, (protocol_name,))
-                
-                snapshot = cursor.fetchone()
-                
-                if snapshot:
-                    status = determine_protocol_status(protocol_name)
-                    
-                    protocol_info = {
-                        'name': protocol_name,
-                        'tvl': decimal_to_float(snapshot['tvl_usd']) if snapshot['tvl_usd'] else None,
-                        'apy': decimal_to_float(snapshot['apy_7d']) if snapshot['apy_7d'] else None,
-                        'utilization': decimal_to_float(snapshot['utilization_rate']) if snapshot['utilization_rate'] else None,
-                        'status': status,
-                        'last_updated': snapshot['timestamp'].isoformat() if snapshot['timestamp'] else None
-                    }
-                    protocols_data.append(protocol_info)
-                else:
-                    protocols_data.append({
-                        'name': protocol_name,
-                        'tvl': None,
-                        'apy': None,
-                        'utilization': None,
-                        'status': 'unknown',
-                        'last_updated': None
-                    })
-        
-        return JSONResponse(content=protocols_data)
+        return MonitorJSONResponse(
+            protocols_data,
+            headers={'Cache-Control': f'public, max-age={PROTOCOLS_CACHE_TTL}'}
+        )
         
     except Exception as e:
         logger.error(f"Error fetching protocols: {e}")
         raise HTTPException(status_code=500, detail="Internal server error")
 
 
+def _encode_history(name: str, days: int) -> bytes:
+    """
+    Fetch a protocol's history and encode it as one JSON array.
+    
+    Rows come from a server-side cursor HISTORY_FETCH_SIZE at a time and are
+    encoded page by page, so no list of row dicts is built for the full
+    window. The whole window is read here so the pooled connection is back
+    in the pool before the response is sent; a slow client never holds it.
+    """
+    chunks = [b'[']
+    separator = b''
+    with db.get_cursor(name='protocol_history') as cursor:
+        cursor.execute("""
+            SELECT timestamp,
+                tvl_usd::float8 AS tvl,
+                apy_7d::float8 AS apy,
+                utilization_rate::float8 AS utilization
+            FROM protocol_snapshots
+            WHERE protocol_name = %s
+            AND timestamp > NOW() - make_interval(days => %s)
+            ORDER BY timestamp DESC
+        """, (name, days))
+        
+        while True:
+            rows = cursor.fetchmany(HISTORY_FETCH_SIZE)
+            if not rows:
+                break
+            # Encode the batch as an array and splice its items into ours
+            chunks.append(separator + orjson.dumps(rows, default=_json_default, option=orjson.OPT_NAIVE_UTC)[1:-1])
+            separator = b','
+    chunks.append(b']')
+    return b''.join(chunks)
+
+
 @app.get("/protocols/{name}/history")
-async def get_protocol_history(
+def get_protocol_history(
     name: str,
     days: int = Query(default=30, ge=1, le=365, description="Number of days of history to retrieve")
 ):
@@ -149,39 +256,17 @@ async def get_protocol_history(
         raise HTTPException(status_code=404, detail=f"Protocol '{name}' not found")
     
     try:
-        with db.get_cursor() as cursor:
-            cursor.execute("""
-                SELECT timestamp, tvl_usd, apy_7d, utilization_rate
-                FROM protocol_snapshots
-                WHERE protocol_name = %s
-                AND timestamp > NOW() - INTERVAL '%s days'
-                ORDER BY timestamp DESC
-            """, (name, days))
-            
-            history = cursor.fetchall()
-            
-            if not history:
-                return JSONResponse(content=[])
-            
-            history_data = [
-                {
-                    'timestamp': record['timestamp'].isoformat() if record['timestamp'] else None,
-                    'tvl': decimal_to_float(record['tvl_usd']) if record['tvl_usd'] else None,
-                    'apy': decimal_to_float(record['apy_7d']) if record['apy_7d'] else None,
-                    'utilization': decimal_to_float(record['utilization_rate']) if record['utilization_rate'] else None
-                }
-                for record in history
-            ]
-            
-            return JSONResponse(content=history_data)
+        content = _encode_history(name, days)
             
     except Exception as e:
         logger.error(f"Error fetching history for {name}: {e}")
         raise HTTPException(status_code=500, detail="Internal server error")
+    
+    return Response(content, media_type="application/json")
 
 
 @app.get("/alerts")
-async def get_alerts(
+def get_alerts(
     status: str = Query(default="open", description="Filter by status: 'open', 'resolved', or 'all'")
 ):
     """
@@ -197,14 +282,16 @@ async def get_alerts(
         with db.get_cursor() as cursor:
             if status == "open":
                 cursor.execute("""
-                    SELECT id, protocol_name, alert_type, severity, message, triggered_at, resolved_at
+                    SELECT id, protocol_name, alert_type, severity, message, triggered_at, resolved_at,
+                        CASE WHEN resolved_at IS NULL THEN 'open' ELSE 'resolved' END AS status
                     FROM protocol_alerts
                     WHERE resolved_at IS NULL
                     ORDER BY triggered_at DESC
                 """)
             elif status == "resolved":
                 cursor.execute("""
-                    SELECT id, protocol_name, alert_type, severity, message, triggered_at, resolved_at
+                    SELECT id, protocol_name, alert_type, severity, message, triggered_at, resolved_at,
+                        CASE WHEN resolved_at IS NULL THEN 'open' ELSE 'resolved' END AS status
                     FROM protocol_alerts
                     WHERE resolved_at IS NOT NULL
                     ORDER BY triggered_at DESC
@@ -212,29 +299,15 @@ async def get_alerts(
                 """)
             else:  # all
                 cursor.execute("""
-                    SELECT id, protocol_name, alert_type, severity, message, triggered_at, resolved_at
+                    SELECT id, protocol_name, alert_type, severity, message, triggered_at, resolved_at,
+                        CASE WHEN resolved_at IS NULL THEN 'open' ELSE 'resolved' END AS status
                     FROM protocol_alerts
                     ORDER BY triggered_at DESC
                     LIMIT 100
                 """)
             
-            alerts = cursor.fetchall()
-            
-            alerts_data = [
-                {
-                    'id': alert['id'],
-                    'protocol_name': alert['protocol_name'],
-                    'alert_type': alert['alert_type'],
-                    'severity': alert['severity'],
-                    'message': alert['message'],
-                    'triggered_at': alert['triggered_at'].isoformat() if alert['triggered_at'] else None,
-                    'resolved_at': alert['resolved_at'].isoformat() if alert['resolved_at'] else None,
-                    'status': 'open' if alert['resolved_at'] is None else 'resolved'
-                }
-                for alert in alerts
-            ]
-            
-            return JSONResponse(content=alerts_data)
+            # Rows already have the response shape; orjson encodes datetimes natively
+            return MonitorJSONResponse(cursor.fetchall())
             
     except Exception as e:
         logger.error(f"Error fetching alerts: {e}")
@@ -242,11 +315,11 @@ async def get_alerts(
 
 
 @app.get("/health")
-async def health_check():
+def health_check():
     """Health check endpoint."""
     try:
         # Test database connection
-        with db.get_cursor() as cursor:
+        with db.get_cursor(dict_cursor=False) as cursor:
             cursor.execute("SELECT 1")
         
         return {
@@ -255,13 +328,13 @@ async def health_check():
         }
     except Exception as e:
         logger.error(f"Health check failed: {e}")
-        return JSONResponse(
-            status_code=503,
-            content={
+        return MonitorJSONResponse(
+            {
                 "status": "unhealthy",
                 "error": str(e),
-                "timestamp": datetime.now(timezone.utc).isoformat()
-            }
+                "timestamp": datetime.now(timezone.utc)
+            },
+            status_code=503
         )
 
 
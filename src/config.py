@@ -23,14 +23,29 @@ PROTOCOLS = {
 ANOMALY_THRESHOLDS = {
     'tvl_drop_24h_percent': 20.0,  # Critical if TVL drops >20% in 24h
     'apy_min_percent': 2.0,        # Warning if APY drops below 2%
-    'utilization_max_percent': 95.0  # Warning if utilization >95%
+    'utilization_max_percent': 95.0,  # Warning if utilization >95%
+    'zscore_escalate': 3.5  # Escalate rule alerts that are also >3.5σ outliers
 }
 
+# Streaming detector: samples kept per metric for the rolling baseline
+STREAMING_WINDOW_SIZE = 48
+
 # API settings
 DEFILLAMA_API_BASE = 'https://api.llama.fi'
 REQUEST_TIMEOUT = 30  # seconds
 MAX_RETRIES = 3
-RETRY_DELAY = 2  # seconds
+RETRY_DELAY = 2  # seconds, base of the exponential backoff
+MAX_BACKOFF = 30  # seconds, longest wait between retries
+
+# /protocols response cache (snapshots change at most once a minute)
+PROTOCOLS_CACHE_TTL = 15  # seconds
+
+# Rows fetched per round-trip when reading /protocols/{name}/history
+HISTORY_FETCH_SIZE = 1000
+
+# Database connection pool
+DB_POOL_MIN_CONN = 1
+DB_POOL_MAX_CONN = 8
 
 # Logging
 LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO')
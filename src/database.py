@@ -1,54 +1,317 @@
 """Database connection and initialization module."""
 
 import os
+import threading
 import psycopg2
+import psycopg2.extensions
 from psycopg2.extras import RealDictCursor
-from contextlib import contextmanager
+from psycopg2.pool import ThreadedConnectionPool
+from collections import namedtuple
+from contextlib import contextmanager, nullcontext
+from functools import cached_property
+from types import MappingProxyType
 import logging
+from typing import List, Sequence, Tuple
+
+from config import DB_POOL_MIN_CONN, DB_POOL_MAX_CONN
 
 logger = logging.getLogger(__name__)
 
+# Hot, fixed statements prepared once per pooled connection so Postgres skips
+# parse/plan on every call. Run them with EXECUTE <name>(%s, ...).
+# Each entry maps a name to (parameter types, statement).
+# Snapshot columns as the anomaly checks consume them: plain floats, with
+# utilization already converted to a percentage.
+_SNAPSHOT_COLUMNS = """protocol_name, timestamp,
+            tvl_usd::float8 AS tvl_usd,
+            apy_7d::float8 AS apy_7d,
+            utilization_rate::float8 * 100 AS utilization_pct"""
+
+# Row shape of _SNAPSHOT_COLUMNS. The detector reads snapshots with plain
+# tuple cursors and wraps them in this instead of building a dict per row.
+Snapshot = namedtuple('Snapshot', 'protocol_name timestamp tvl_usd apy_7d utilization_pct')
+
+PREPARED_STATEMENTS = {
+    'latest_snapshot': ('text', f"""
+        SELECT {_SNAPSHOT_COLUMNS}
+        FROM protocol_snapshots
+        WHERE protocol_name = $1
+        ORDER BY timestamp DESC
+        LIMIT 1
+    """),
+    'snapshot_before': ('text, timestamptz', f"""
+        SELECT {_SNAPSHOT_COLUMNS}
+        FROM protocol_snapshots
+        WHERE protocol_name = $1
+        AND timestamp <= $2
+        ORDER BY timestamp DESC
+        LIMIT 1
+    """),
+    'latest_and_24h': ('text', f"""
+        WITH latest AS (
+            SELECT {_SNAPSHOT_COLUMNS}
+            FROM protocol_snapshots
+            WHERE protocol_name = $1
+            ORDER BY timestamp DESC
+            LIMIT 1
+        )
+        SELECT 'latest' AS snapshot, * FROM latest
+        UNION ALL
+        (
+            SELECT '24h' AS snapshot, {_SNAPSHOT_COLUMNS}
+            FROM protocol_snapshots
+            WHERE protocol_name = $1
+            AND timestamp <= (SELECT timestamp FROM latest) - INTERVAL '24 hours'
+            ORDER BY timestamp DESC
+            LIMIT 1
+        )
+    """),
+    'latest_with_24h': ('text[]', f"""
+        SELECT latest.*, prev.timestamp, prev.tvl_usd, prev.apy_7d, prev.utilization_pct
+        FROM (
+            SELECT DISTINCT ON (protocol_name) {_SNAPSHOT_COLUMNS}
+            FROM protocol_snapshots
+            WHERE protocol_name = ANY($1)
+            ORDER BY protocol_name, timestamp DESC
+        ) latest
+        LEFT JOIN LATERAL (
+            SELECT {_SNAPSHOT_COLUMNS}
+            FROM protocol_snapshots s
+            WHERE s.protocol_name = latest.protocol_name
+            AND s.timestamp <= latest.timestamp - INTERVAL '24 hours'
+            ORDER BY s.timestamp DESC
+            LIMIT 1
+        ) prev ON TRUE
+    """),
+    'snapshot_windows': ('text[], timestamptz', f"""
+        SELECT recent.*
+        FROM unnest($1) AS p(protocol_name)
+        CROSS JOIN LATERAL (
+            SELECT {_SNAPSHOT_COLUMNS}
+            FROM protocol_snapshots s
+            WHERE s.protocol_name = p.protocol_name
+            AND s.timestamp < $2
+            AND s.timestamp >= COALESCE((
+                SELECT b.timestamp FROM protocol_snapshots b
+                WHERE b.protocol_name = p.protocol_name
+                AND b.timestamp <= $2 - INTERVAL '24 hours'
+                ORDER BY b.timestamp DESC
+                LIMIT 1
+            ), '-infinity')
+        ) recent
+        ORDER BY recent.protocol_name, recent.timestamp
+    """),
+    'protocol_overview': ('text[]', """
+        SELECT DISTINCT ON (protocol_name)
+            protocol_name, timestamp,
+            tvl_usd::float8 AS tvl_usd,
+            apy_7d::float8 AS apy_7d,
+            utilization_rate::float8 AS utilization_rate
+        FROM protocol_snapshots
+        WHERE protocol_name = ANY($1)
+        ORDER BY protocol_name, timestamp DESC
+    """),
+    'insert_snapshot': ('text, timestamptz, numeric, numeric, numeric', """
+        INSERT INTO protocol_snapshots
+        (protocol_name, timestamp, tvl_usd, apy_7d, utilization_rate)
+        VALUES ($1, $2, $3, $4, $5)
+        ON CONFLICT (protocol_name, timestamp) DO NOTHING
+    """),
+    'insert_alert_if_new': ('text, text, text, text, timestamptz', """
+        INSERT INTO protocol_alerts
+        (protocol_name, alert_type, severity, message, triggered_at)
+        SELECT $1, $2, $3, $4, $5
+        WHERE NOT EXISTS (
+            SELECT 1 FROM protocol_alerts
+            WHERE protocol_name = $1
+            AND alert_type = $2
+            AND resolved_at IS NULL
+            AND triggered_at > NOW() - INTERVAL '1 hour'
+        )
+        RETURNING id
+    """),
+    'protocol_statuses': ('text[]', """
+        SELECT DISTINCT ON (protocol_name) protocol_name, severity
+        FROM protocol_alerts
+        WHERE protocol_name = ANY($1)
+        AND resolved_at IS NULL
+        AND triggered_at > NOW() - INTERVAL '24 hours'
+        ORDER BY protocol_name,
+            CASE severity
+                WHEN 'critical' THEN 1
+                WHEN 'warning' THEN 2
+                ELSE 3
+            END
+    """),
+}
+
+
+class _PooledConnection(psycopg2.extensions.connection):
+    """Connection that remembers whether PREPARED_STATEMENTS exist on it."""
+    statements_prepared = False
+
 
 class Database:
     """Database connection manager."""
     
     def __init__(self):
-        self.db_config = {
+        # The pool is created on first use so importing this module never
+        # opens a connection.
+        self._pool = None
+        self._pool_lock = threading.Lock()
+        # ThreadedConnectionPool raises when exhausted; the semaphore makes
+        # callers wait for a free connection instead.
+        self._pool_slots = threading.BoundedSemaphore(DB_POOL_MAX_CONN)
+    
+    @cached_property
+    def db_config(self) -> MappingProxyType:
+        """Connection settings, read from the environment on first use."""
+        return MappingProxyType({
             'host': os.getenv('DB_HOST', 'localhost'),
             'port': os.getenv('DB_PORT', '5432'),
             'database': os.getenv('DB_NAME', 'protocol_monitor'),
             'user': os.getenv('DB_USER', 'postgres'),
             'password': os.getenv('DB_PASSWORD', 'postgres')
-        }
+        })
     
-    @contextmanager
-    def get_connection(self):
-        """Get a database connection context manager."""
-        conn = None
+    @cached_property
+    def dsn(self) -> str:
+        """libpq connection string built from db_config."""
+        return psycopg2.extensions.make_dsn(**self.db_config)
+    
+    def _get_pool(self) -> ThreadedConnectionPool:
+        """Return the shared connection pool, creating it on first use."""
+        if self._pool is None:
+            with self._pool_lock:
+                if self._pool is None:
+                    self._pool = ThreadedConnectionPool(
+                        DB_POOL_MIN_CONN, DB_POOL_MAX_CONN,
+                        dsn=self.dsn, connection_factory=_PooledConnection
+                    )
+        return self._pool
+    
+    def _prepare_statements(self, conn):
+        """
+        PREPARE the hot statements on a connection the first time it is used.
+        
+        On failure the connection is still usable for plain SQL (e.g. to run
+        init_schema() against a fresh database), but get_connection() closes
+        it on release instead of returning it to the pool.
+        """
         try:
-            conn = psycopg2.connect(**self.db_config)
-            yield conn
+            with conn.cursor() as cursor:
+                # Prepared statements survive a rollback, so clear any left
+                # over from an earlier failed attempt on this connection
+                cursor.execute("DEALLOCATE ALL")
+                for name, (param_types, statement) in PREPARED_STATEMENTS.items():
+                    cursor.execute(f"PREPARE {name} ({param_types}) AS {statement}")
             conn.commit()
-        except Exception as e:
-            if conn:
-                conn.rollback()
-            logger.error(f"Database error: {e}")
-            raise
-        finally:
-            if conn:
-                conn.close()
+            conn.statements_prepared = True
+        except psycopg2.Error as e:
+            # e.g. tables not created yet; the next checkout gets a fresh
+            # connection and tries again
+            conn.rollback()
+            logger.warning(f"Could not prepare statements, connection will be discarded: {e}")
+    
+    @contextmanager
+    def get_connection(self):
+        """Get a pooled database connection context manager."""
+        with self._pool_slots:
+            pool = None
+            conn = None
+            try:
+                pool = self._get_pool()
+                conn = pool.getconn()
+                if not conn.statements_prepared:
+                    self._prepare_statements(conn)
+                yield conn
+                conn.commit()
+            except Exception as e:
+                if conn and not conn.closed:
+                    conn.rollback()
+                logger.error(f"Database error: {e}")
+                raise
+            finally:
+                if conn:
+                    # Broken or unprepared connections are not handed out again
+                    pool.putconn(conn, close=bool(conn.closed) or not conn.statements_prepared)
     
     @contextmanager
-    def get_cursor(self, dict_cursor=True):
-        """Get a database cursor context manager."""
+    def session(self):
+        """
+        Hold one pooled connection for a batch of statements.
+        
+        The connection runs in autocommit mode, so each statement commits on
+        its own just like separate get_cursor() calls, but without checking
+        out a connection per query.
+        """
         with self.get_connection() as conn:
+            conn.autocommit = True
+            try:
+                yield conn
+            finally:
+                if not conn.closed:
+                    conn.autocommit = False
+    
+    @contextmanager
+    def get_cursor(self, dict_cursor=True, connection=None, name=None):
+        """
+        Get a database cursor context manager.
+        
+        Pass `connection` (e.g. from session()) to open the cursor on a
+        connection the caller already holds instead of borrowing a new one.
+        Pass `name` for a server-side cursor that fetches rows on demand;
+        these need a transaction, so not a session() connection.
+        """
+        connection_ctx = nullcontext(connection) if connection is not None else self.get_connection()
+        with connection_ctx as conn:
             cursor_factory = RealDictCursor if dict_cursor else None
-            cursor = conn.cursor(cursor_factory=cursor_factory)
+            cursor = conn.cursor(name=name, cursor_factory=cursor_factory)
             try:
                 yield cursor
             finally:
                 cursor.close()
     
+    def bulk_insert_snapshots(self, rows: Sequence[Tuple], update_existing: bool = False) -> List[str]:
+        """
+        Insert many protocol snapshots with a single multi-row INSERT.
+        
+        Args:
+            rows: Sequence of (protocol_name, timestamp, tvl_usd, apy_7d, utilization_rate) tuples
+            update_existing: Overwrite metrics of snapshots that already exist
+                instead of skipping them
+        
+        Returns:
+            Protocol names of the snapshots that were written
+        """
+        if not rows:
+            return []
+        
+        if update_existing:
+            on_conflict = """DO UPDATE SET
+                tvl_usd = EXCLUDED.tvl_usd,
+                apy_7d = EXCLUDED.apy_7d,
+                utilization_rate = EXCLUDED.utilization_rate"""
+        else:
+            on_conflict = "DO NOTHING"
+        
+        with self.get_cursor(dict_cursor=False) as cursor:
+            # Render every row into one statement so the whole batch is a
+            # single round trip (execute_values would page it)
+            values = b",".join(cursor.mogrify("(%s, %s, %s, %s, %s)", row) for row in rows)
+            cursor.execute(
+                b"""
+                INSERT INTO protocol_snapshots
+                (protocol_name, timestamp, tvl_usd, apy_7d, utilization_rate)
+                VALUES """ + values + f"""
+                ON CONFLICT (protocol_name, timestamp) {on_conflict}
+                RETURNING protocol_name
+                """.encode()
+            )
+            written = cursor.fetchall()
+        
+        return [row[0] for row in written]
+    
     def init_schema(self, schema_file='sql/schema.sql'):
         """Initialize database schema from SQL file."""
         try:
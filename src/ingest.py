@@ -1,93 +1,247 @@
 """Data ingestion module for fetching protocol metrics."""
 
+import asyncio
 import requests
+from requests.adapters import HTTPAdapter
 import logging
+import random
 import time
+from operator import itemgetter
 from datetime import datetime, timezone
-from typing import Dict, Optional, List
-from decimal import Decimal
+from email.utils import parsedate_to_datetime
+from typing import Dict, Optional, List, Tuple
+
+import orjson
 
 from config import (
     PROTOCOLS, DEFILLAMA_API_BASE, REQUEST_TIMEOUT,
-    MAX_RETRIES, RETRY_DELAY
+    MAX_RETRIES, RETRY_DELAY, MAX_BACKOFF
 )
 from database import db
 
+try:
+    import httpx
+except ImportError:  # concurrent fetching falls back to the sync client
+    httpx = None
+
+# Exceptions a GET raises when the request timed out, for either client
+_TIMEOUT_ERRORS = (requests.exceptions.Timeout,) + ((httpx.TimeoutException,) if httpx is not None else ())
+
+try:
+    import h2  # noqa: F401 -- lets httpx negotiate HTTP/2
+    _HTTP2 = True
+except ImportError:
+    _HTTP2 = False
+
 logger = logging.getLogger(__name__)
 
+REQUEST_HEADERS = {
+    'User-Agent': 'TokenMetrics-Monitor/1.0'
+}
+
+# Snapshot dict keys in protocol_snapshots column order
+_SNAPSHOT_FIELDS = ('protocol_name', 'timestamp', 'tvl_usd', 'apy_7d', 'utilization_rate')
+_snapshot_row = itemgetter(*_SNAPSHOT_FIELDS)
+
+# Mock APY (%) and utilization (fraction) until on-chain reads are wired up
+_MOCK_APYS = {
+    'aave-v3': 3.45,
+    'compound-v3': 4.25
+}
+_MOCK_UTILIZATION = {
+    'aave-v3': 0.7250,  # 72.5%
+    'compound-v3': 0.6850  # 68.5%
+}
+
+# What a response's status class means for the fetch loop; 429 is the one
+# 4xx worth retrying (see _status_action)
+_STATUS_ACTIONS = {2: 'ok', 4: 'fatal', 5: 'retry'}
+
+# Shared by every fetcher so keep-alive connections to DefiLlama (and their
+# TLS handshakes) are reused across instances and pipeline runs
+_SESSION = requests.Session()
+_SESSION.mount('https://', HTTPAdapter(pool_connections=8, pool_maxsize=32, max_retries=0))
+_SESSION.headers.update(REQUEST_HEADERS)
+
+
+def _retry_after_seconds(value) -> Optional[float]:
+    """Parse a Retry-After header (delta-seconds or HTTP-date) into seconds."""
+    if value is None:
+        return None
+    try:
+        return max(float(value), 0.0)
+    except (TypeError, ValueError):
+        pass
+    try:
+        return max((parsedate_to_datetime(value) - datetime.now(timezone.utc)).total_seconds(), 0.0)
+    except (TypeError, ValueError):
+        return None
+
+
+def _status_action(status: int) -> str:
+    """Classify an HTTP status as 'ok', 'retry' or 'fatal'."""
+    if status == 429:
+        return 'retry'
+    return _STATUS_ACTIONS.get(status // 100, 'fatal')
+
+
+def _backoff_delay(attempt: int, retry_after: Optional[float] = None) -> float:
+    """
+    Seconds to wait before retry number `attempt + 1`.
+    
+    Full jitter over an exponentially growing window, so fetchers retrying
+    after the same outage spread out instead of hitting DefiLlama in lockstep.
+    A server-provided Retry-After is honored as given (up to MAX_BACKOFF).
+    """
+    if retry_after is not None:
+        return min(retry_after, MAX_BACKOFF)
+    return random.uniform(0, min(RETRY_DELAY * (2 ** attempt), MAX_BACKOFF))
+
+
+def _next_step(url: str, attempt: int, max_retries: int,
+               response=None, error: Optional[Exception] = None) -> Tuple[Optional[float], Optional[Dict]]:
+    """
+    Decide what a fetch loop does after one attempt.
+    
+    `response` is a requests or httpx response (only status_code, headers
+    and content are read); `error` is the exception the GET raised instead.
+    
+    Returns:
+        (delay, data): sleep `delay` seconds and try again, or, when delay
+        is None, stop and return `data` (None on failure)
+    """
+    if error is not None:
+        if isinstance(error, _TIMEOUT_ERRORS):
+            logger.warning("Timeout fetching %s", url)
+        else:
+            logger.error("Request error fetching %s: %s", url, error)
+        retry_after = None
+    else:
+        action = _status_action(response.status_code)
+        
+        if action == 'ok':
+            try:
+                return None, orjson.loads(response.content)
+            except orjson.JSONDecodeError as e:
+                logger.error("Malformed response from %s: %s", url, e)
+                return None, None
+        
+        if action == 'fatal':
+            logger.error("Client error %d for %s", response.status_code, url)
+            return None, None
+        
+        # 5xx errors and rate limiting
+        logger.warning("Server error %d for %s", response.status_code, url)
+        retry_after = _retry_after_seconds(response.headers.get('Retry-After'))
+    
+    if attempt < max_retries - 1:
+        return _backoff_delay(attempt, retry_after), None
+    return None, None
+
 
 class ProtocolDataFetcher:
     """Fetches protocol data from various sources."""
     
-    def __init__(self):
-        self.session = requests.Session()
-        self.session.headers.update({
-            'User-Agent': 'TokenMetrics-Monitor/1.0'
-        })
+    def __init__(self, session: Optional[requests.Session] = None):
+        """
+        Args:
+            session: HTTP session for the sync fetches; defaults to the
+                module-wide pooled session
+        """
+        self.session = session if session is not None else _SESSION
     
     def fetch_with_retry(self, url: str, max_retries: int = MAX_RETRIES) -> Optional[Dict]:
         """Fetch data with retry logic for handling timeouts and errors."""
         for attempt in range(max_retries):
+            logger.info("Fetching %s (attempt %d/%d)", url, attempt + 1, max_retries)
             try:
-                logger.info(f"Fetching {url} (attempt {attempt + 1}/{max_retries})")
                 response = self.session.get(url, timeout=REQUEST_TIMEOUT)
-                
-                # Handle 5xx errors
-                if 500 <= response.status_code < 600:
-                    logger.warning(f"Server error {response.status_code} for {url}")
-                    if attempt < max_retries - 1:
-                        time.sleep(RETRY_DELAY * (attempt + 1))
-                        continue
-                    return None
-                
-                response.raise_for_status()
-                return response.json()
-                
-            except requests.exceptions.Timeout:
-                logger.warning(f"Timeout fetching {url}")
-                if attempt < max_retries - 1:
-                    time.sleep(RETRY_DELAY * (attempt + 1))
-                    continue
-                return None
-                
             except requests.exceptions.RequestException as e:
-                logger.error(f"Request error fetching {url}: {e}")
-                if attempt < max_retries - 1:
-                    time.sleep(RETRY_DELAY * (attempt + 1))
-                    continue
-                return None
-                
-            except ValueError as e:
-                logger.error(f"Malformed response from {url}: {e}")
-                return None
+                delay, data = _next_step(url, attempt, max_retries, error=e)
+            else:
+                delay, data = _next_step(url, attempt, max_retries, response=response)
+            
+            if delay is None:
+                return data
+            time.sleep(delay)
         
         return None
     
-    def fetch_tvl_from_defillama(self, protocol_slug: str) -> Optional[Decimal]:
-        """Fetch TVL data from DefiLlama API."""
-        url = f"{DEFILLAMA_API_BASE}/tvl/{protocol_slug}"
-        data = self.fetch_with_retry(url)
+    async def fetch_with_retry_async(self, client, url: str, max_retries: int = MAX_RETRIES) -> Optional[Dict]:
+        """Async counterpart of fetch_with_retry on a shared httpx.AsyncClient."""
+        for attempt in range(max_retries):
+            logger.info("Fetching %s (attempt %d/%d)", url, attempt + 1, max_retries)
+            try:
+                response = await client.get(url)
+            except httpx.HTTPError as e:
+                delay, data = _next_step(url, attempt, max_retries, error=e)
+            else:
+                delay, data = _next_step(url, attempt, max_retries, response=response)
+            
+            if delay is None:
+                return data
+            await asyncio.sleep(delay)
         
+        return None
+    
+    def _tvl_url(self, protocol_slug: str) -> str:
+        """DefiLlama TVL endpoint for a protocol."""
+        return f"{DEFILLAMA_API_BASE}/tvl/{protocol_slug}"
+    
+    def _extract_tvl(self, data, protocol_slug: str) -> Optional[float]:
+        """Pull the TVL out of a DefiLlama /tvl response."""
         if data and isinstance(data, (int, float)):
-            return Decimal(str(data))
+            return float(data)
         elif data and isinstance(data, dict) and 'tvl' in data:
-            return Decimal(str(data['tvl']))
+            return float(data['tvl'])
         
-        logger.warning(f"Could not extract TVL for {protocol_slug}")
+        logger.warning("Could not extract TVL for %s", protocol_slug)
         return None
     
-    def fetch_protocol_data(self, protocol_key: str) -> Optional[Dict]:
-        """Fetch comprehensive protocol data."""
+    def fetch_tvl_from_defillama(self, protocol_slug: str) -> Optional[float]:
+        """Fetch TVL data from DefiLlama API."""
+        data = self.fetch_with_retry(self._tvl_url(protocol_slug))
+        return self._extract_tvl(data, protocol_slug)
+    
+    async def fetch_tvl_from_defillama_async(self, client, protocol_slug: str) -> Optional[float]:
+        """Fetch TVL data from DefiLlama API on an httpx.AsyncClient."""
+        data = await self.fetch_with_retry_async(client, self._tvl_url(protocol_slug))
+        return self._extract_tvl(data, protocol_slug)
+    
+    def fetch_protocol_data(self, protocol_key: str, timestamp: Optional[datetime] = None) -> Optional[Dict]:
+        """Fetch comprehensive protocol data, stamped with `timestamp` (default now)."""
+        timestamp = timestamp or datetime.now(timezone.utc)
         protocol_config = PROTOCOLS.get(protocol_key)
         if not protocol_config:
-            logger.error(f"Unknown protocol: {protocol_key}")
+            logger.error("Unknown protocol: %s", protocol_key)
             return None
         
-        logger.info(f"Fetching data for {protocol_config['name']}")
+        logger.info("Fetching data for %s", protocol_config['name'])
         
         # Fetch TVL from DefiLlama
         tvl = self.fetch_tvl_from_defillama(protocol_config['defillama_slug'])
         
+        return self._build_protocol_data(protocol_key, tvl, timestamp)
+    
+    async def fetch_protocol_data_async(self, client, protocol_key: str,
+                                        timestamp: Optional[datetime] = None) -> Optional[Dict]:
+        """Fetch comprehensive protocol data on an httpx.AsyncClient."""
+        timestamp = timestamp or datetime.now(timezone.utc)
+        protocol_config = PROTOCOLS.get(protocol_key)
+        if not protocol_config:
+            logger.error("Unknown protocol: %s", protocol_key)
+            return None
+        
+        logger.info("Fetching data for %s", protocol_config['name'])
+        
+        tvl = await self.fetch_tvl_from_defillama_async(client, protocol_config['defillama_slug'])
+        
+        return self._build_protocol_data(protocol_key, tvl, timestamp)
+    
+    def _build_protocol_data(self, protocol_key: str, tvl: Optional[float], timestamp: datetime) -> Optional[Dict]:
+        """Combine a fetched TVL with the remaining metrics into a snapshot."""
+        protocol_config = PROTOCOLS[protocol_key]
+        
         # Mock APY and utilization data (in real implementation, fetch from on-chain)
         # For demonstration, we'll generate realistic mock data
         apy_7d = self.fetch_mock_apy(protocol_key)
@@ -97,75 +251,148 @@ class ProtocolDataFetcher:
             utilization_rate = self.fetch_mock_utilization(protocol_key)
         
         if tvl is None:
-            logger.warning(f"Failed to fetch data for {protocol_key}")
+            logger.warning("Failed to fetch data for %s", protocol_key)
             return None
         
         return {
             'protocol_name': protocol_key,
-            'timestamp': datetime.now(timezone.utc),
+            'timestamp': timestamp,
             'tvl_usd': tvl,
             'apy_7d': apy_7d,
             'utilization_rate': utilization_rate
         }
     
-    def fetch_mock_apy(self, protocol_key: str) -> Optional[Decimal]:
+    def fetch_mock_apy(self, protocol_key: str) -> Optional[float]:
         """Mock APY fetching (replace with actual on-chain reads)."""
-        # Simulate realistic APY values
-        mock_apys = {
-            'aave-v3': Decimal('3.45'),
-            'compound-v3': Decimal('4.25')
-        }
-        return mock_apys.get(protocol_key)
+        return _MOCK_APYS.get(protocol_key)
     
-    def fetch_mock_utilization(self, protocol_key: str) -> Optional[Decimal]:
+    def fetch_mock_utilization(self, protocol_key: str) -> Optional[float]:
         """Mock utilization rate fetching (replace with actual on-chain reads)."""
-        # Simulate realistic utilization rates
-        mock_utilization = {
-            'aave-v3': Decimal('0.7250'),  # 72.5%
-            'compound-v3': Decimal('0.6850')  # 68.5%
-        }
-        return mock_utilization.get(protocol_key)
+        return _MOCK_UTILIZATION.get(protocol_key)
     
     def save_snapshot(self, snapshot_data: Dict) -> bool:
         """Save protocol snapshot to database with idempotency."""
         try:
             with db.get_cursor(dict_cursor=False) as cursor:
-                cursor.execute("""
-                    INSERT INTO protocol_snapshots 
-                    (protocol_name, timestamp, tvl_usd, apy_7d, utilization_rate)
-                    VALUES (%(protocol_name)s, %(timestamp)s, %(tvl_usd)s, %(apy_7d)s, %(utilization_rate)s)
-                    ON CONFLICT (protocol_name, timestamp) DO NOTHING
-                """, snapshot_data)
+                cursor.execute("EXECUTE insert_snapshot(%s, %s, %s, %s, %s)", _snapshot_row(snapshot_data))
                 
                 if cursor.rowcount > 0:
-                    logger.info(f"Saved snapshot for {snapshot_data['protocol_name']}")
+                    logger.info("Saved snapshot for %s", snapshot_data['protocol_name'])
                     return True
                 else:
-                    logger.info(f"Snapshot already exists for {snapshot_data['protocol_name']} at {snapshot_data['timestamp']}")
+                    logger.info("Snapshot already exists for %s at %s", snapshot_data['protocol_name'], snapshot_data['timestamp'])
                     return False
                     
         except Exception as e:
-            logger.error(f"Failed to save snapshot: {e}")
+            logger.error("Failed to save snapshot: %s", e)
             return False
     
-    def ingest_all_protocols(self) -> Dict[str, bool]:
-        """Ingest data for all configured protocols."""
+    def save_snapshots_batch(self, snapshots: List[Dict]) -> Dict[str, bool]:
+        """
+        Save many protocol snapshots in a single INSERT with idempotency.
+        
+        Returns:
+            Dictionary mapping protocol names to whether a new snapshot was written
+        """
+        if not snapshots:
+            return {}
+        
+        try:
+            written = set(db.bulk_insert_snapshots([_snapshot_row(snapshot) for snapshot in snapshots]))
+        except Exception as e:
+            logger.error("Failed to save %d snapshots: %s", len(snapshots), e)
+            return {snapshot['protocol_name']: False for snapshot in snapshots}
+        
         results = {}
+        for snapshot in snapshots:
+            protocol_name = snapshot['protocol_name']
+            results[protocol_name] = protocol_name in written
+            
+            if results[protocol_name]:
+                logger.info("Saved snapshot for %s", protocol_name)
+            else:
+                logger.info("Snapshot already exists for %s at %s", protocol_name, snapshot['timestamp'])
+        
+        return results
+    
+    async def fetch_all_protocol_data_async(self, timestamp: Optional[datetime] = None) -> Dict[str, Optional[Dict]]:
+        """
+        Fetch every protocol concurrently over one httpx.AsyncClient, all
+        stamped with one timestamp.
         
-        for protocol_key in PROTOCOLS.keys():
+        With h2 installed the client speaks HTTP/2, so concurrent requests
+        to DefiLlama are multiplexed over a single TLS connection.
+        """
+        protocol_keys = tuple(PROTOCOLS)
+        timestamp = timestamp or datetime.now(timezone.utc)
+        limits = httpx.Limits(max_connections=16, max_keepalive_connections=16)
+        
+        # follow_redirects matches requests, so both clients treat a moved
+        # DefiLlama endpoint the same way
+        async with httpx.AsyncClient(http2=_HTTP2, timeout=REQUEST_TIMEOUT, limits=limits,
+                                     headers=REQUEST_HEADERS, follow_redirects=True) as client:
+            fetched = await asyncio.gather(
+                *(self.fetch_protocol_data_async(client, key, timestamp) for key in protocol_keys),
+                return_exceptions=True
+            )
+        
+        results = {}
+        for protocol_key, data in zip(protocol_keys, fetched):
+            if isinstance(data, Exception):
+                logger.error("Error fetching %s: %s", protocol_key, data, exc_info=data)
+                data = None
+            results[protocol_key] = data
+        
+        return results
+    
+    def fetch_all_protocol_data(self, timestamp: Optional[datetime] = None) -> Dict[str, Optional[Dict]]:
+        """
+        Fetch data for all configured protocols.
+        
+        Requests run concurrently when httpx is available, otherwise one
+        after another on the sync session. Every snapshot is stamped with
+        `timestamp` (default: the time of the call).
+        
+        Returns:
+            Dictionary mapping protocol names to fetched data (None on failure)
+        """
+        if httpx is not None:
+            return asyncio.run(self.fetch_all_protocol_data_async(timestamp))
+        
+        timestamp = timestamp or datetime.now(timezone.utc)
+        results = {}
+        for protocol_key in tuple(PROTOCOLS):
             try:
-                data = self.fetch_protocol_data(protocol_key)
-                if data:
-                    success = self.save_snapshot(data)
-                    results[protocol_key] = success
-                else:
-                    results[protocol_key] = False
-                    logger.error(f"Failed to fetch data for {protocol_key}")
+                results[protocol_key] = self.fetch_protocol_data(protocol_key, timestamp)
             except Exception as e:
-                logger.error(f"Error processing {protocol_key}: {e}", exc_info=True)
-                results[protocol_key] = False
+                logger.error("Error fetching %s: %s", protocol_key, e, exc_info=True)
+                results[protocol_key] = None
         
         return results
+    
+    def _save_fetched(self, fetched: Dict[str, Optional[Dict]]) -> Dict[str, bool]:
+        """Save every successfully fetched snapshot in one batch."""
+        for protocol_key, data in fetched.items():
+            if not data:
+                logger.error("Failed to fetch data for %s", protocol_key)
+        
+        results = {protocol_key: False for protocol_key in fetched}
+        results.update(self.save_snapshots_batch([data for data in fetched.values() if data]))
+        return results
+    
+    async def ingest_all_async(self) -> Dict[str, bool]:
+        """Fetch all protocols concurrently, then save them in one batch."""
+        fetched = await self.fetch_all_protocol_data_async()
+        
+        # Postgres writes are blocking; keep them off the event loop
+        return await asyncio.to_thread(self._save_fetched, fetched)
+    
+    def ingest_all_protocols(self) -> Dict[str, bool]:
+        """Ingest data for all configured protocols."""
+        if httpx is not None:
+            return asyncio.run(self.ingest_all_async())
+        
+        return self._save_fetched(self.fetch_all_protocol_data())
 
 
 def run_ingestion():
@@ -179,7 +406,7 @@ def run_ingestion():
     results = fetcher.ingest_all_protocols()
     
     success_count = sum(1 for v in results.values() if v)
-    logger.info(f"Ingestion complete: {success_count}/{len(results)} protocols successful")
+    logger.info("Ingestion complete: %d/%d protocols successful", success_count, len(results))
     
     return results
 
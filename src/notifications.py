@@ -2,15 +2,65 @@
 
 import os
 import requests
+from requests.adapters import HTTPAdapter
 import logging
-from typing import Dict, Optional
+import orjson
+from typing import Dict, List, Optional
 
 logger = logging.getLogger(__name__)
 
+# One pooled session for all webhook posts, so a burst of alerts shares a
+# single TLS connection to Slack. Created on first post (see _session).
+_SESSION: Optional[requests.Session] = None
+
+# Shared notifier, created on first use (see get_slack_notifier)
+_instance: Optional['SlackNotifier'] = None
+
+
+def _session() -> requests.Session:
+    """Return the shared webhook session, creating it on first use."""
+    global _SESSION
+    if _SESSION is None:
+        session = requests.Session()
+        session.mount('https://', HTTPAdapter(pool_connections=8, pool_maxsize=32, max_retries=0))
+        session.headers.update({
+            'User-Agent': 'TokenMetrics-Monitor/1.0'
+        })
+        _SESSION = session
+    return _SESSION
+
 
 # Sentinel value to distinguish between None and not-provided
 _UNSET = object()
 
+# (attachment color, header emoji) per severity
+_SEV_STYLE = {
+    'CRITICAL': ('#FF0000', '🚨'),  # Red
+    'WARNING': ('#FFA500', '⚠️'),   # Orange
+    'INFO': ('#0000FF', 'ℹ️')       # Blue
+}
+_DEFAULT_STYLE = ('#808080', '📊')
+
+# Slack renders at most this many attachments per message
+_MAX_ATTACHMENTS = 50
+
+# Webhook bodies are encoded with orjson and posted as raw bytes
+_JSON_HEADERS = {'Content-Type': 'application/json'}
+
+# The integration test message never changes, so encode it once
+_TEST_MESSAGE_BODY = orjson.dumps({
+    "text": "✅ Token Metrics Monitor - Slack Integration Test",
+    "blocks": [
+        {
+            "type": "section",
+            "text": {
+                "type": "mrkdwn",
+                "text": "Slack integration is working correctly! You will receive alerts here when anomalies are detected."
+            }
+        }
+    ]
+})
+
 class SlackNotifier:
     """Send alerts to Slack channel via webhook."""
     
@@ -30,74 +80,61 @@ class SlackNotifier:
     
     def _format_alert_message(self, alert: Dict) -> Dict:
         """Format alert data into Slack message blocks."""
+        return {"attachments": [self._format_attachment(alert)]}
+    
+    def _format_attachment(self, alert: Dict) -> Dict:
+        """Format one alert as a colored Slack attachment."""
         severity = alert['severity'].upper()
         protocol = alert['protocol_name']
         message = alert['message']
         
-        # Choose color based on severity
-        color_map = {
-            'CRITICAL': '#FF0000',  # Red
-            'WARNING': '#FFA500',   # Orange
-            'INFO': '#0000FF'       # Blue
-        }
-        color = color_map.get(severity, '#808080')
+        # Choose color and emoji based on severity
+        color, emoji = _SEV_STYLE.get(severity, _DEFAULT_STYLE)
         
-        # Choose emoji based on severity
-        emoji_map = {
-            'CRITICAL': '🚨',
-            'WARNING': '⚠️',
-            'INFO': 'ℹ️'
-        }
-        emoji = emoji_map.get(severity, '📊')
-        
-        # Build Slack message
-        slack_message = {
-            "attachments": [
+        # Build Slack attachment
+        attachment = {
+            "color": color,
+            "blocks": [
                 {
-                    "color": color,
-                    "blocks": [
+                    "type": "header",
+                    "text": {
+                        "type": "plain_text",
+                        "text": f"{emoji} {severity} Alert: {protocol}",
+                        "emoji": True
+                    }
+                },
+                {
+                    "type": "section",
+                    "fields": [
                         {
-                            "type": "header",
-                            "text": {
-                                "type": "plain_text",
-                                "text": f"{emoji} {severity} Alert: {protocol}",
-                                "emoji": True
-                            }
+                            "type": "mrkdwn",
+                            "text": f"*Protocol:*\n{protocol}"
                         },
                         {
-                            "type": "section",
-                            "fields": [
-                                {
-                                    "type": "mrkdwn",
-                                    "text": f"*Protocol:*\n{protocol}"
-                                },
-                                {
-                                    "type": "mrkdwn",
-                                    "text": f"*Severity:*\n{severity}"
-                                },
-                                {
-                                    "type": "mrkdwn",
-                                    "text": f"*Alert Type:*\n{alert['alert_type']}"
-                                },
-                                {
-                                    "type": "mrkdwn",
-                                    "text": f"*Time:*\n{alert['triggered_at'].strftime('%Y-%m-%d %H:%M:%S UTC')}"
-                                }
-                            ]
+                            "type": "mrkdwn",
+                            "text": f"*Severity:*\n{severity}"
                         },
                         {
-                            "type": "section",
-                            "text": {
-                                "type": "mrkdwn",
-                                "text": f"*Details:*\n{message}"
-                            }
+                            "type": "mrkdwn",
+                            "text": f"*Alert Type:*\n{alert['alert_type']}"
+                        },
+                        {
+                            "type": "mrkdwn",
+                            "text": f"*Time:*\n{alert['triggered_at'].strftime('%Y-%m-%d %H:%M:%S UTC')}"
                         }
                     ]
+                },
+                {
+                    "type": "section",
+                    "text": {
+                        "type": "mrkdwn",
+                        "text": f"*Details:*\n{message}"
+                    }
                 }
             ]
         }
         
-        return slack_message
+        return attachment
     
     def send_alert(self, alert: Dict) -> bool:
         """
@@ -109,29 +146,48 @@ class SlackNotifier:
         Returns:
             True if sent successfully, False otherwise
         """
+        return self.send_alerts([alert])
+    
+    def send_alerts(self, alerts: List[Dict]) -> bool:
+        """
+        Send several alerts to Slack, one attachment each, in as few webhook
+        posts as Slack's attachment limit allows.
+        
+        Returns:
+            True if every post succeeded, False otherwise
+        """
         if not self.enabled:
             logger.debug("Slack notifications disabled, skipping alert")
             return False
         
-        try:
-            message = self._format_alert_message(alert)
-            
-            response = requests.post(
-                self.webhook_url,
-                json=message,
-                timeout=10
-            )
-            
-            if response.status_code == 200:
-                logger.info(f"Sent Slack notification for {alert['protocol_name']} - {alert['alert_type']}")
-                return True
-            else:
-                logger.error(f"Failed to send Slack notification: {response.status_code} - {response.text}")
-                return False
+        if not alerts:
+            return True
+        
+        success = True
+        for start in range(0, len(alerts), _MAX_ATTACHMENTS):
+            batch = alerts[start:start + _MAX_ATTACHMENTS]
+            try:
+                body = orjson.dumps({"attachments": [self._format_attachment(alert) for alert in batch]})
                 
-        except Exception as e:
-            logger.error(f"Error sending Slack notification: {e}")
-            return False
+                response = _session().post(
+                    self.webhook_url,
+                    data=body,
+                    headers=_JSON_HEADERS,
+                    timeout=10
+                )
+                
+                if response.status_code == 200:
+                    for alert in batch:
+                        logger.info(f"Sent Slack notification for {alert['protocol_name']} - {alert['alert_type']}")
+                else:
+                    logger.error(f"Failed to send Slack notification: {response.status_code} - {response.text}")
+                    success = False
+                    
+            except Exception as e:
+                logger.error(f"Error sending Slack notification: {e}")
+                success = False
+        
+        return success
     
     def send_test_message(self) -> bool:
         """Send a test message to verify Slack integration."""
@@ -139,23 +195,11 @@ class SlackNotifier:
             logger.warning("Cannot send test message: Slack webhook not configured")
             return False
         
-        test_message = {
-            "text": "✅ Token Metrics Monitor - Slack Integration Test",
-            "blocks": [
-                {
-                    "type": "section",
-                    "text": {
-                        "type": "mrkdwn",
-                        "text": "Slack integration is working correctly! You will receive alerts here when anomalies are detected."
-                    }
-                }
-            ]
-        }
-        
         try:
-            response = requests.post(
+            response = _session().post(
                 self.webhook_url,
-                json=test_message,
+                data=_TEST_MESSAGE_BODY,
+                headers=_JSON_HEADERS,
                 timeout=10
             )
             
@@ -171,8 +215,15 @@ class SlackNotifier:
             return False
 
 
-# Singleton instance
-slack_notifier = SlackNotifier()
+def get_slack_notifier() -> SlackNotifier:
+    """
+    Return the shared notifier, configured from SLACK_WEBHOOK_URL the first
+    time it is needed rather than at import.
+    """
+    global _instance
+    if _instance is None:
+        _instance = SlackNotifier()
+    return _instance
 
 
 if __name__ == '__main__':
@@ -3,96 +3,146 @@
 import logging
 import sys
 from datetime import datetime, timezone
-from typing import Dict, List
+from typing import Dict, List, Optional
 
 from database import db
 from ingest import ProtocolDataFetcher
-from anomaly_detector import AnomalyDetector
+from anomaly_detector import AnomalyDetector, StreamingDetector, snapshot_from_data
 from config import PROTOCOLS, LOG_LEVEL, LOG_FORMAT
 
 logger = logging.getLogger(__name__)
 
+# Protocol order for every phase of a run
+_PROTOCOL_KEYS = tuple(PROTOCOLS)
+
 
 class MonitoringPipeline:
     """Main monitoring pipeline with error handling and resilience."""
     
     def __init__(self):
         self.fetcher = ProtocolDataFetcher()
-        self.detector = AnomalyDetector()
+        # Alerts of a run go out to Slack together once detection finishes
+        self.detector = AnomalyDetector(batch_notifications=True)
+        self.streaming_detector = StreamingDetector(self.detector)
+        # Alerts from snapshots checked as they were ingested in the current
+        # run, by protocol; reset by run_ingestion()
+        self.ingest_alerts: Dict[str, List[Dict]] = {}
         self.run_id = datetime.now(timezone.utc).isoformat()
     
     def log_pipeline_run(self, status: str, details: Dict):
         """Log pipeline execution details."""
-        logger.info(f"Pipeline run {self.run_id} - Status: {status}")
-        logger.info(f"Details: {details}")
+        logger.info("Pipeline run %s - Status: %s", self.run_id, status)
+        logger.info("Details: %s", details)
     
-    def run_ingestion(self) -> Dict[str, bool]:
+    def run_ingestion(self, timestamp: Optional[datetime] = None) -> Dict[str, bool]:
         """
         Run data ingestion with error handling.
         
+        Every snapshot of the run is stamped with `timestamp` (default now).
+        
         Returns:
             Dictionary mapping protocol names to success status
         """
         logger.info("Starting data ingestion phase...")
         results = {}
+        # Protocols not checked on ingest this run fall through to the
+        # database checks in run_anomaly_detection()
+        self.ingest_alerts = {}
+        
+        # Fetch every protocol concurrently, then write them in one INSERT
+        fetched = self.fetcher.fetch_all_protocol_data(timestamp)
+        to_save = [data for data in fetched.values() if data]
+        saved = self.fetcher.save_snapshots_batch(to_save)
         
-        for protocol_name in PROTOCOLS.keys():
-            try:
-                logger.info(f"Ingesting data for {protocol_name}")
-                data = self.fetcher.fetch_protocol_data(protocol_name)
-                
-                if data:
-                    success = self.fetcher.save_snapshot(data)
-                    results[protocol_name] = success
-                    
-                    if success:
-                        logger.info(f"✓ Successfully ingested {protocol_name}")
-                    else:
-                        logger.warning(f"⚠ Data already exists for {protocol_name} (idempotent)")
-                else:
-                    results[protocol_name] = False
-                    logger.error(f"✗ Failed to fetch data for {protocol_name}")
-                    
-            except Exception as e:
-                # Failed fetch doesn't crash the pipeline
-                logger.error(f"✗ Error processing {protocol_name}: {e}", exc_info=True)
-                results[protocol_name] = False
+        # Load every rolling window the fused checks need in one query
+        unseen = [data['protocol_name'] for data in to_save
+                  if saved.get(data['protocol_name']) and not self.streaming_detector.has_window(data['protocol_name'])]
+        if unseen:
+            self.streaming_detector.warm_start(unseen, before=min(data['timestamp'] for data in to_save))
+        
+        for protocol_name in _PROTOCOL_KEYS:
+            results[protocol_name] = self.process_protocol(protocol_name, fetched.get(protocol_name), saved)
         
         success_count = sum(1 for v in results.values() if v)
-        logger.info(f"Ingestion complete: {success_count}/{len(results)} protocols successful")
+        logger.info("Ingestion complete: %d/%d protocols successful", success_count, len(results))
         
         return results
     
+    def process_protocol(self, protocol_name: str, data: Optional[Dict], saved: Dict[str, bool]) -> bool:
+        """
+        Finish one protocol of an ingestion run: record whether its snapshot
+        was saved and, if so, check it for anomalies straight away.
+        
+        Returns:
+            True if the snapshot was saved
+        """
+        try:
+            logger.info("Ingesting data for %s", protocol_name)
+            
+            if not data:
+                logger.error("✗ Failed to fetch data for %s", protocol_name)
+                return False
+            
+            if not saved.get(protocol_name, False):
+                logger.warning("⚠ Data already exists for %s (idempotent)", protocol_name)
+                return False
+            
+            logger.info("✓ Successfully ingested %s", protocol_name)
+            self.detect_on_ingest(protocol_name, data)
+            return True
+            
+        except Exception as e:
+            # Failed fetch doesn't crash the pipeline
+            logger.error("✗ Error processing %s: %s", protocol_name, e, exc_info=True)
+            return False
+    
+    def detect_on_ingest(self, protocol_name: str, data: Dict):
+        """Check a just-saved snapshot in memory, without reading it back from the database."""
+        try:
+            self.ingest_alerts[protocol_name] = self.streaming_detector.update(snapshot_from_data(data))
+        except Exception as e:
+            # Left for the detection phase to check from the database
+            logger.error("✗ Error checking %s on ingest: %s", protocol_name, e, exc_info=True)
+    
     def run_anomaly_detection(self) -> Dict[str, List[Dict]]:
         """
         Run anomaly detection with error handling.
         
+        Protocols already checked on ingest reuse those alerts; the rest
+        (failed or skipped ingestion) have their snapshots loaded in one
+        query and are then checked concurrently.
+        
         Returns:
             Dictionary mapping protocol names to detected alerts
         """
         logger.info("Starting anomaly detection phase...")
+        detected = dict(self.ingest_alerts)
+        
+        pending = [name for name in _PROTOCOL_KEYS if name not in self.ingest_alerts]
+        if pending:
+            logger.info("Checking anomalies for %s", ", ".join(pending))
+            # One query loads latest and 24h-ago snapshots for all of them
+            snapshots = self.detector.get_snapshots_batch(pending)
+            detected.update(self.detector.detect_anomalies_batch(snapshots, pending))
+        
         all_alerts = {}
+        for protocol_name in _PROTOCOL_KEYS:
+            alerts = detected[protocol_name]
+            all_alerts[protocol_name] = alerts
+            
+            if alerts:
+                logger.warning("⚠ Detected %d anomalies for %s", len(alerts), protocol_name)
+                for alert in alerts:
+                    logger.warning("  - %s: %s", alert['severity'].upper(), alert['message'])
+            else:
+                logger.info("✓ No anomalies detected for %s", protocol_name)
         
-        for protocol_name in PROTOCOLS.keys():
-            try:
-                logger.info(f"Checking anomalies for {protocol_name}")
-                alerts = self.detector.detect_anomalies(protocol_name)
-                all_alerts[protocol_name] = alerts
-                
-                if alerts:
-                    logger.warning(f"⚠ Detected {len(alerts)} anomalies for {protocol_name}")
-                    for alert in alerts:
-                        logger.warning(f"  - {alert['severity'].upper()}: {alert['message']}")
-                else:
-                    logger.info(f"✓ No anomalies detected for {protocol_name}")
-                    
-            except Exception as e:
-                # Failed detection doesn't crash the pipeline
-                logger.error(f"✗ Error detecting anomalies for {protocol_name}: {e}", exc_info=True)
-                all_alerts[protocol_name] = []
+        # Alerts raised on ingest are saved in the background
+        self.streaming_detector.flush()
+        self.detector.flush_notifications()
         
         total_alerts = sum(len(alerts) for alerts in all_alerts.values())
-        logger.info(f"Anomaly detection complete: {total_alerts} total alerts")
+        logger.info("Anomaly detection complete: %d total alerts", total_alerts)
         
         return all_alerts
     
@@ -104,9 +154,9 @@ class MonitoringPipeline:
             Summary of pipeline execution
         """
         start_time = datetime.now(timezone.utc)
-        logger.info(f"=" * 60)
-        logger.info(f"Starting monitoring pipeline run: {self.run_id}")
-        logger.info(f"=" * 60)
+        logger.info("=" * 60)
+        logger.info("Starting monitoring pipeline run: %s", self.run_id)
+        logger.info("=" * 60)
         
         summary = {
             'run_id': self.run_id,
@@ -118,7 +168,7 @@ class MonitoringPipeline:
         
         try:
             # Phase 1: Data Ingestion
-            ingestion_results = self.run_ingestion()
+            ingestion_results = self.run_ingestion(start_time)
             summary['ingestion_results'] = ingestion_results
             
             # Check if at least one protocol was successful
@@ -134,7 +184,7 @@ class MonitoringPipeline:
             }
             
         except Exception as e:
-            logger.error(f"Pipeline failed with critical error: {e}", exc_info=True)
+            logger.error("Pipeline failed with critical error: %s", e, exc_info=True)
             summary['status'] = 'failed'
             summary['error'] = str(e)
         
@@ -144,10 +194,10 @@ class MonitoringPipeline:
         summary['end_time'] = end_time.isoformat()
         summary['duration_seconds'] = duration
         
-        logger.info(f"=" * 60)
-        logger.info(f"Pipeline run complete: {summary['status']}")
-        logger.info(f"Duration: {duration:.2f} seconds")
-        logger.info(f"=" * 60)
+        logger.info("=" * 60)
+        logger.info("Pipeline run complete: %s", summary['status'])
+        logger.info("Duration: %.2f seconds", duration)
+        logger.info("=" * 60)
         
         self.log_pipeline_run(summary['status'], summary)
         
@@ -188,7 +238,7 @@ def main():
             sys.exit(2)
             
     except Exception as e:
-        logger.error(f"Fatal error: {e}", exc_info=True)
+        logger.error("Fatal error: %s", e, exc_info=True)
         sys.exit(2)
 
 
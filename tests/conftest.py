@@ -5,33 +5,112 @@ import os
 import sys
 from datetime import datetime, timezone
 from decimal import Decimal
+from types import MappingProxyType
 
 # Add src to path
 sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
 
 
-@pytest.fixture
+def pytest_configure(config):
+    """
+    With FAST_TESTS=1, act as if run with -p no:cacheprovider.
+    
+    The cache plugin is already configured by the time conftest loads, so
+    drop the plugins that write .pytest_cache at the end of every run.
+    """
+    if os.getenv('FAST_TESTS') == '1':
+        for name in ('lfplugin', 'nfplugin', 'stepwise'):
+            plugin = config.pluginmanager.get_plugin(name)
+            if plugin is not None:
+                config.pluginmanager.unregister(plugin)
+
+
+# Fixed timestamp for sample data; assertions never compare against the live clock
+NOW = datetime(2024, 1, 1, 12, 0, tzinfo=timezone.utc)
+
+
+# Built once per test session; fixtures hand out read-only views
+_SAMPLE_PROTOCOL_DATA = MappingProxyType({
+    'protocol_name': 'test-protocol',
+    'timestamp': NOW,
+    'tvl_usd': Decimal('1000000.00'),
+    'apy_7d': Decimal('5.25'),
+    'utilization_rate': Decimal('0.7500')
+})
+
+_SAMPLE_ALERT_DATA = MappingProxyType({
+    'protocol_name': 'test-protocol',
+    'alert_type': 'tvl_drop',
+    'severity': 'critical',
+    'message': 'TVL dropped 25% in 24 hours',
+    'triggered_at': NOW
+})
+
+
+@pytest.fixture(scope="session")
 def sample_protocol_data():
-    """Sample protocol snapshot data for testing."""
-    return {
-        'protocol_name': 'test-protocol',
-        'timestamp': datetime.now(timezone.utc),
-        'tvl_usd': Decimal('1000000.00'),
-        'apy_7d': Decimal('5.25'),
-        'utilization_rate': Decimal('0.7500')
-    }
+    """Sample protocol snapshot data for testing (read-only)."""
+    return _SAMPLE_PROTOCOL_DATA
 
 
 @pytest.fixture
+def sample_protocol_data_fresh():
+    """Mutable copy of the sample snapshot for tests that modify it."""
+    return dict(_SAMPLE_PROTOCOL_DATA)
+
+
+@pytest.fixture(scope="session")
 def sample_alert_data():
-    """Sample alert data for testing."""
-    return {
-        'protocol_name': 'test-protocol',
-        'alert_type': 'tvl_drop',
-        'severity': 'critical',
-        'message': 'TVL dropped 25% in 24 hours',
-        'triggered_at': datetime.now(timezone.utc)
-    }
+    """Sample alert data for testing (read-only)."""
+    return _SAMPLE_ALERT_DATA
+
+
+class FakeCursor:
+    """Minimal stand-in for a db.get_cursor() context manager and its cursor."""
+    
+    def __init__(self, fetchone=None, fetchall=(), rowcount=1):
+        self._fetchone = fetchone
+        self._fetchall = list(fetchall)
+        self.rowcount = rowcount
+        self.executed = []
+        self.closed = False
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, *exc_info):
+        self.closed = True
+        return False
+    
+    def execute(self, query, params=None):
+        self.executed.append((query, params))
+    
+    def mogrify(self, query, params=()):
+        # Rough client-side rendering, enough to inspect the SQL a caller builds
+        def literal(value):
+            if value is None:
+                return 'NULL'
+            if isinstance(value, (str, datetime)):
+                return f"'{value}'"
+            return str(value)
+        return (query % tuple(literal(value) for value in params)).encode()
+    
+    def fetchone(self):
+        return self._fetchone
+    
+    def fetchall(self):
+        return self._fetchall
+    
+    def fetchmany(self, size=1):
+        # Pages through the fetchall rows, like a server-side cursor
+        page, self._fetchall = self._fetchall[:size], self._fetchall[size:]
+        return page
+
+
+@pytest.fixture
+def fake_cursor():
+    """Factory for FakeCursor: fake_cursor(fetchone=..., fetchall=..., rowcount=...)."""
+    return FakeCursor
 
 
 @pytest.fixture
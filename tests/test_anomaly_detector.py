@@ -1,11 +1,17 @@
 """Tests for the anomaly detection module."""
 
+import statistics
 import pytest
-from unittest.mock import Mock, patch, MagicMock
+from unittest.mock import Mock, patch
 from datetime import datetime, timedelta, timezone
 from decimal import Decimal
 
-from anomaly_detector import AnomalyDetector
+from anomaly_detector import (
+    AnomalyDetector, StreamingDetector, snapshot_from_data, _ProtocolWindow, _RollingStats
+)
+from database import Snapshot
+
+NOW = datetime(2024, 1, 1, 12, 0, tzinfo=timezone.utc)
 
 
 class TestAnomalyDetector:
@@ -18,86 +24,99 @@ class TestAnomalyDetector:
         assert 'tvl_drop_24h_percent' in detector.thresholds
     
     @patch('anomaly_detector.db.get_cursor')
-    def test_get_latest_snapshot(self, mock_cursor):
+    def test_get_latest_snapshot(self, mock_cursor, fake_cursor):
         """Test getting latest snapshot."""
-        mock_cursor_obj = MagicMock()
-        mock_cursor_obj.__enter__.return_value.fetchone.return_value = {
-            'protocol_name': 'test-protocol',
-            'tvl_usd': Decimal('1000000.00'),
-            'apy_7d': Decimal('5.25'),
-            'timestamp': datetime.now(timezone.utc)
-        }
-        mock_cursor.return_value = mock_cursor_obj
+        mock_cursor.return_value = fake_cursor(fetchone=(
+            'test-protocol', NOW, 1000000.0, 5.25, 75.0
+        ))
         
         detector = AnomalyDetector()
         snapshot = detector.get_latest_snapshot('test-protocol')
         
-        assert snapshot is not None
-        assert snapshot['protocol_name'] == 'test-protocol'
+        assert isinstance(snapshot, Snapshot)
+        assert snapshot.protocol_name == 'test-protocol'
+        assert snapshot.tvl_usd == 1000000.0
     
     @patch('anomaly_detector.db.get_cursor')
-    def test_check_tvl_drop_critical(self, mock_cursor):
-        """Test TVL drop detection for critical threshold."""
-        now = datetime.now(timezone.utc)
+    def test_get_latest_and_24h(self, mock_cursor, fake_cursor):
+        """Test fetching latest and 24h-ago snapshots in one query."""
+        cursor = mock_cursor.return_value = fake_cursor(fetchall=[
+            ('latest', 'test-protocol', NOW, 800000.0, 5.0, 50.0),
+            ('24h', 'test-protocol', NOW - timedelta(hours=24), 1000000.0, 5.0, 50.0)
+        ])
+        
+        detector = AnomalyDetector()
+        latest, snapshot_24h = detector.get_latest_and_24h('test-protocol')
         
+        assert latest.tvl_usd == 800000.0
+        assert snapshot_24h.tvl_usd == 1000000.0
+        assert latest.protocol_name == 'test-protocol'
+        assert len(cursor.executed) == 1
+    
+    def test_check_tvl_drop_critical(self):
+        """Test TVL drop detection for critical threshold."""
         # Mock latest snapshot
-        latest = {
-            'protocol_name': 'test-protocol',
-            'tvl_usd': Decimal('800000.00'),
-            'timestamp': now
-        }
+        latest = Snapshot(
+            protocol_name='test-protocol',
+            timestamp=NOW,
+            tvl_usd=800000.0,
+            apy_7d=None,
+            utilization_pct=None
+        )
         
         # Mock 24h ago snapshot
-        snapshot_24h = {
-            'protocol_name': 'test-protocol',
-            'tvl_usd': Decimal('1000000.00'),
-            'timestamp': now - timedelta(hours=24)
-        }
+        snapshot_24h = Snapshot(
+            protocol_name='test-protocol',
+            timestamp=NOW - timedelta(hours=24),
+            tvl_usd=1000000.0,
+            apy_7d=None,
+            utilization_pct=None
+        )
         
         detector = AnomalyDetector()
         
-        with patch.object(detector, 'get_latest_snapshot', return_value=latest):
-            with patch.object(detector, 'get_snapshot_24h_ago', return_value=snapshot_24h):
-                alert = detector.check_tvl_drop('test-protocol')
+        with patch.object(detector, 'get_latest_and_24h', return_value=(latest, snapshot_24h)):
+            alert = detector.check_tvl_drop('test-protocol')
         
         assert alert is not None
         assert alert['alert_type'] == 'tvl_drop'
         assert alert['severity'] == 'critical'
         assert '20' in alert['message']
     
-    @patch('anomaly_detector.db.get_cursor')
-    def test_check_tvl_drop_no_alert(self, mock_cursor):
+    def test_check_tvl_drop_no_alert(self):
         """Test TVL drop detection when below threshold."""
-        now = datetime.now(timezone.utc)
-        
-        latest = {
-            'protocol_name': 'test-protocol',
-            'tvl_usd': Decimal('950000.00'),
-            'timestamp': now
-        }
+        latest = Snapshot(
+            protocol_name='test-protocol',
+            timestamp=NOW,
+            tvl_usd=950000.0,
+            apy_7d=None,
+            utilization_pct=None
+        )
         
-        snapshot_24h = {
-            'protocol_name': 'test-protocol',
-            'tvl_usd': Decimal('1000000.00'),
-            'timestamp': now - timedelta(hours=24)
-        }
+        snapshot_24h = Snapshot(
+            protocol_name='test-protocol',
+            timestamp=NOW - timedelta(hours=24),
+            tvl_usd=1000000.0,
+            apy_7d=None,
+            utilization_pct=None
+        )
         
         detector = AnomalyDetector()
         
-        with patch.object(detector, 'get_latest_snapshot', return_value=latest):
-            with patch.object(detector, 'get_snapshot_24h_ago', return_value=snapshot_24h):
-                alert = detector.check_tvl_drop('test-protocol')
+        with patch.object(detector, 'get_latest_and_24h', return_value=(latest, snapshot_24h)):
+            alert = detector.check_tvl_drop('test-protocol')
         
         assert alert is None
     
-    @patch('anomaly_detector.db.get_cursor')
-    def test_check_apy_low_warning(self, mock_cursor):
+    def test_check_apy_low_warning(self):
         """Test APY low detection."""
-        latest = {
-            'protocol_name': 'test-protocol',
-            'apy_7d': Decimal('1.5'),
-            'timestamp': datetime.now(timezone.utc)
-        }
+        latest = Snapshot(
+            protocol_name='test-protocol',
+            timestamp=NOW,
+            tvl_usd=None,
+            apy_7d=1.5,
+            utilization_pct=None
+        )
         
         detector = AnomalyDetector()
         
@@ -108,14 +127,15 @@ class TestAnomalyDetector:
         assert alert['alert_type'] == 'apy_low'
         assert alert['severity'] == 'warning'
     
-    @patch('anomaly_detector.db.get_cursor')
-    def test_check_apy_low_no_alert(self, mock_cursor):
+    def test_check_apy_low_no_alert(self):
         """Test APY low detection when above threshold."""
-        latest = {
-            'protocol_name': 'test-protocol',
-            'apy_7d': Decimal('5.5'),
-            'timestamp': datetime.now(timezone.utc)
-        }
+        latest = Snapshot(
+            protocol_name='test-protocol',
+            timestamp=NOW,
+            tvl_usd=None,
+            apy_7d=5.5,
+            utilization_pct=None
+        )
         
         detector = AnomalyDetector()
         
@@ -124,15 +144,16 @@ class TestAnomalyDetector:
         
         assert alert is None
     
-    @patch('anomaly_detector.db.get_cursor')
     @patch('anomaly_detector.PROTOCOLS', {'test-protocol': {'type': 'lending'}})
-    def test_check_utilization_high_warning(self, mock_cursor):
+    def test_check_utilization_high_warning(self):
         """Test high utilization detection."""
-        latest = {
-            'protocol_name': 'test-protocol',
-            'utilization_rate': Decimal('0.97'),
-            'timestamp': datetime.now(timezone.utc)
-        }
+        latest = Snapshot(
+            protocol_name='test-protocol',
+            timestamp=NOW,
+            tvl_usd=None,
+            apy_7d=None,
+            utilization_pct=97.0
+        )
         
         detector = AnomalyDetector()
         
@@ -143,15 +164,16 @@ class TestAnomalyDetector:
         assert alert['alert_type'] == 'utilization_high'
         assert alert['severity'] == 'warning'
     
-    @patch('anomaly_detector.db.get_cursor')
     @patch('anomaly_detector.PROTOCOLS', {'test-protocol': {'type': 'lending'}})
-    def test_check_utilization_high_no_alert(self, mock_cursor):
+    def test_check_utilization_high_no_alert(self):
         """Test high utilization detection when below threshold."""
-        latest = {
-            'protocol_name': 'test-protocol',
-            'utilization_rate': Decimal('0.85'),
-            'timestamp': datetime.now(timezone.utc)
-        }
+        latest = Snapshot(
+            protocol_name='test-protocol',
+            timestamp=NOW,
+            tvl_usd=None,
+            apy_7d=None,
+            utilization_pct=85.0
+        )
         
         detector = AnomalyDetector()
         
@@ -160,12 +182,11 @@ class TestAnomalyDetector:
         
         assert alert is None
     
+    @patch('anomaly_detector._SLACK_POOL')
     @patch('anomaly_detector.db.get_cursor')
-    def test_save_alert_success(self, mock_cursor):
+    def test_save_alert_success(self, mock_cursor, mock_pool, fake_cursor):
         """Test saving alert to database."""
-        mock_cursor_obj = MagicMock()
-        mock_cursor_obj.__enter__.return_value.fetchone.return_value = None
-        mock_cursor.return_value = mock_cursor_obj
+        mock_cursor.return_value = fake_cursor(rowcount=1)
         
         detector = AnomalyDetector()
         alert_data = {
@@ -173,18 +194,47 @@ class TestAnomalyDetector:
             'alert_type': 'tvl_drop',
             'severity': 'critical',
             'message': 'Test alert',
-            'triggered_at': datetime.now(timezone.utc)
+            'triggered_at': NOW
         }
         
         result = detector.save_alert(alert_data)
         assert result is True
+        mock_pool.submit.assert_called_once()
+        assert mock_pool.submit.call_args.args[1] is alert_data
     
+    @patch('anomaly_detector.get_slack_notifier')
+    @patch('anomaly_detector._SLACK_POOL')
     @patch('anomaly_detector.db.get_cursor')
-    def test_save_alert_duplicate(self, mock_cursor):
+    def test_save_alert_batched_notifications(self, mock_cursor, mock_pool, mock_notifier, fake_cursor):
+        """Test that batched alerts are sent together on flush."""
+        mock_cursor.return_value = fake_cursor(rowcount=1)
+        
+        detector = AnomalyDetector(batch_notifications=True)
+        alerts = [
+            {
+                'protocol_name': name,
+                'alert_type': 'tvl_drop',
+                'severity': 'critical',
+                'message': 'Test alert',
+                'triggered_at': NOW
+            }
+            for name in ('a', 'b')
+        ]
+        
+        for alert in alerts:
+            assert detector.save_alert(alert) is True
+        mock_pool.submit.assert_not_called()
+        
+        detector.flush_notifications()
+        detector.flush_notifications()
+        
+        mock_notifier.return_value.send_alerts.assert_called_once_with(alerts)
+    
+    @patch('anomaly_detector._SLACK_POOL')
+    @patch('anomaly_detector.db.get_cursor')
+    def test_save_alert_duplicate(self, mock_cursor, mock_pool, fake_cursor):
         """Test saving duplicate alert (should be skipped)."""
-        mock_cursor_obj = MagicMock()
-        mock_cursor_obj.__enter__.return_value.fetchone.return_value = {'id': 1}
-        mock_cursor.return_value = mock_cursor_obj
+        mock_cursor.return_value = fake_cursor(rowcount=0)
         
         detector = AnomalyDetector()
         alert_data = {
@@ -192,8 +242,169 @@ class TestAnomalyDetector:
             'alert_type': 'tvl_drop',
             'severity': 'critical',
             'message': 'Test alert',
-            'triggered_at': datetime.now(timezone.utc)
+            'triggered_at': NOW
         }
         
         result = detector.save_alert(alert_data)
         assert result is False
+        mock_pool.submit.assert_not_called()
+    
+    @patch('anomaly_detector.db.get_cursor')
+    def test_detect_anomalies_reuses_cursor(self, mock_cursor, fake_cursor):
+        """Test that all checks share the caller's cursor."""
+        cursor = fake_cursor()
+        
+        detector = AnomalyDetector()
+        alerts = detector.detect_anomalies('test-protocol', cursor=cursor)
+        
+        assert alerts == []
+        assert cursor.executed
+        mock_cursor.assert_not_called()
+    
+    @patch('anomaly_detector.PROTOCOLS', {'test-protocol': {'type': 'lending'}})
+    def test_detect_anomalies_fetches_latest_once(self, fake_cursor):
+        """Test that all checks share a single latest-snapshot lookup."""
+        latest = Snapshot(
+            protocol_name='test-protocol',
+            timestamp=NOW,
+            tvl_usd=1000000.0,
+            apy_7d=1.5,
+            utilization_pct=97.0
+        )
+        cursor = fake_cursor()
+        
+        detector = AnomalyDetector()
+        
+        with patch.object(detector, 'get_latest_and_24h', return_value=(latest, None)) as mock_both, \
+                patch.object(detector, 'get_latest_snapshot') as mock_latest, \
+                patch.object(detector, 'save_alert', return_value=True):
+            alerts = detector.detect_anomalies('test-protocol', cursor=cursor)
+        
+        assert [a['alert_type'] for a in alerts] == ['apy_low', 'utilization_high']
+        assert mock_both.call_count == 1
+        mock_latest.assert_not_called()
+    
+    @patch('anomaly_detector.db.get_cursor')
+    def test_get_snapshots_batch(self, mock_cursor, fake_cursor):
+        """Test batched snapshot lookup for several protocols."""
+        cursor = mock_cursor.return_value = fake_cursor(fetchall=[
+            ('a', NOW, 800000.0, 5.0, 50.0, NOW - timedelta(hours=24), 1000000.0, 5.0, 50.0),
+            ('b', NOW, 500000.0, 5.0, 50.0, None, None, None, None)
+        ])
+        
+        detector = AnomalyDetector()
+        snapshots = detector.get_snapshots_batch(['a', 'b', 'c'])
+        
+        assert set(snapshots) == {'a', 'b'}
+        assert snapshots['a'][1].tvl_usd == 1000000.0
+        assert snapshots['a'][1].protocol_name == 'a'
+        assert snapshots['b'][1] is None
+        assert len(cursor.executed) == 1
+    
+    @patch('anomaly_detector.db')
+    @patch('anomaly_detector.PROTOCOLS', {'a': {'type': 'lending'}, 'b': {'type': 'lending'}})
+    def test_detect_all_protocols_uses_batch(self, mock_db):
+        """Test that a sweep fetches snapshots once for all protocols."""
+        latest = Snapshot('a', NOW, 1000000.0, 5.0, 50.0)
+        
+        detector = AnomalyDetector()
+        
+        with patch.object(detector, 'get_snapshots_batch', return_value={'a': (latest, None)}) as mock_batch, \
+                patch.object(detector, 'detect_anomalies', return_value=[]) as mock_detect:
+            results = detector.detect_all_protocols()
+        
+        assert results == {'a': [], 'b': []}
+        assert mock_batch.call_count == 1
+        assert mock_detect.call_count == 1
+        assert mock_detect.call_args.kwargs['latest'] is latest
+    
+    @patch('anomaly_detector.PROTOCOLS', {'a': {'type': 'lending'}, 'b': {'type': 'lending'}})
+    def test_detect_all_protocols_isolates_failures(self):
+        """Test that one protocol failing does not drop the others' alerts."""
+        snapshots = {name: (Snapshot(name, NOW, 1000000.0, 5.0, 50.0), None) for name in ('a', 'b')}
+        
+        def detect(protocol_name, **kwargs):
+            if protocol_name == 'a':
+                raise RuntimeError('boom')
+            return [{'alert_type': 'apy_low'}]
+        
+        detector = AnomalyDetector()
+        
+        with patch.object(detector, 'get_snapshots_batch', return_value=snapshots), \
+                patch.object(detector, 'detect_anomalies', side_effect=detect):
+            results = detector.detect_all_protocols()
+        
+        assert results == {'a': [], 'b': [{'alert_type': 'apy_low'}]}
+
+
+class TestStreamingDetector:
+    """Test cases for StreamingDetector class."""
+    
+    def test_rolling_stats_match_window(self):
+        """Test that sliding updates track the mean and stdev of the window."""
+        stats = _RollingStats(size=10)
+        values = [float(v * v % 17) for v in range(25)]
+        for value in values:
+            stats.add(value)
+        
+        window = values[-10:]
+        probe = 42.0
+        expected = (probe - statistics.mean(window)) / statistics.stdev(window)
+        assert stats.zscore(probe) == pytest.approx(expected)
+    
+    def test_rolling_stats_needs_samples(self):
+        """Test that no z-score is reported before the window has a baseline."""
+        stats = _RollingStats(size=10)
+        for value in (1.0, 2.0, 3.0):
+            stats.add(value)
+        
+        assert stats.zscore(100.0) is None
+    
+    @patch('anomaly_detector._ALERT_POOL')
+    @patch('anomaly_detector.PROTOCOLS', {'test-protocol': {'type': 'lending'}})
+    def test_update_escalates_outliers(self, mock_pool):
+        """Test that a rule alert on an outlying metric is escalated and queued."""
+        start = NOW - timedelta(hours=12)
+        detector = StreamingDetector(window_size=20)
+        # Start from an empty window instead of warm-starting from the database
+        detector._windows['test-protocol'] = _ProtocolWindow(20)
+        
+        for i in range(20):
+            detector.update(Snapshot('test-protocol', start + timedelta(minutes=30 * i),
+                                     1000000.0, 5.0 + (i % 2) * 0.1, 70.0))
+        
+        alerts = detector.update(Snapshot('test-protocol', start + timedelta(hours=11),
+                                          1000000.0, 1.0, 70.0))
+        
+        assert [a['alert_type'] for a in alerts] == ['apy_low']
+        assert alerts[0]['severity'] == 'critical'
+        assert 'σ' in alerts[0]['message']
+        assert mock_pool.submit.call_count == 1
+    
+    @patch('anomaly_detector._ALERT_POOL')
+    @patch('anomaly_detector.db.get_cursor')
+    def test_update_uses_cached_24h_snapshot(self, mock_cursor, mock_pool, fake_cursor):
+        """Test that the TVL check uses warm-started history instead of querying."""
+        mock_cursor.return_value = fake_cursor(fetchall=[
+            ('test-protocol', NOW - timedelta(hours=25), 1000000.0, 5.0, 70.0),
+            ('test-protocol', NOW - timedelta(hours=1), 900000.0, 5.0, 70.0)
+        ])
+        
+        detector = StreamingDetector()
+        alerts = detector.update(Snapshot('test-protocol', NOW, 700000.0, 5.0, 70.0))
+        
+        assert [a['alert_type'] for a in alerts] == ['tvl_drop']
+        assert '30.00%' in alerts[0]['message']
+        assert mock_cursor.call_count == 1
+    
+    def test_snapshot_from_data(self):
+        """Test conversion of fetched snapshot data to a detector Snapshot."""
+        snapshot = snapshot_from_data({
+            'protocol_name': 'test-protocol',
+            'timestamp': NOW,
+            'tvl_usd': Decimal('1000000.50'),
+            'apy_7d': Decimal('3.45'),
+            'utilization_rate': Decimal('0.7250')
+        })
+        
+        assert snapshot == Snapshot('test-protocol', NOW, 1000000.5, 3.45, 72.5)
@@ -1,18 +1,52 @@
 """Tests for the FastAPI endpoints."""
 
+import json
+import threading
 import pytest
-from unittest.mock import Mock, patch, MagicMock
+from concurrent.futures import ThreadPoolExecutor
+from unittest.mock import Mock, patch
 from datetime import datetime, timezone
-from decimal import Decimal
 from fastapi.testclient import TestClient
 
-from api import app
+import api
+from api import app, determine_protocol_statuses
 
+NOW = datetime(2024, 1, 1, 12, 0, tzinfo=timezone.utc)
 
-@pytest.fixture
+OPEN_ALERT = {
+    'id': 1,
+    'protocol_name': 'test-protocol',
+    'alert_type': 'tvl_drop',
+    'severity': 'critical',
+    'message': 'Test alert',
+    'triggered_at': NOW,
+    'resolved_at': None,
+    'status': 'open'
+}
+
+
+@pytest.fixture(scope="session")
 def client():
-    """Create test client."""
-    return TestClient(app)
+    """Create one test client shared by every API test; app startup and shutdown run once."""
+    with TestClient(app) as test_client:
+        yield test_client
+
+
+@pytest.fixture(autouse=True, scope="module")
+def configured_protocols():
+    """Configure a single 'test-protocol' for the whole module."""
+    original = api.PROTOCOLS
+    api.PROTOCOLS = {'test-protocol': {}}
+    yield
+    api.PROTOCOLS = original
+
+
+@pytest.fixture(autouse=True)
+def clear_protocols_cache():
+    """Start every test with an empty /protocols cache."""
+    api._protocols_cache.clear()
+    yield
+    api._protocols_cache.clear()
 
 
 class TestAPIEndpoints:
@@ -23,24 +57,30 @@ class TestAPIEndpoints:
         response = client.get("/")
         assert response.status_code == 200
         data = response.json()
-        assert "message" in data
-        assert "endpoints" in data
+        assert data['message'] == 'Protocol Monitor API'
+        assert '/protocols' in data['endpoints']
     
-    @patch('api.db.get_cursor')
-    @patch('api.PROTOCOLS', {'test-protocol': {}})
-    def test_get_protocols(self, mock_cursor, client):
+    @pytest.mark.parametrize('url, rows, expected', [
+        ("/alerts?status=open", [OPEN_ALERT], [dict(OPEN_ALERT, triggered_at=NOW.isoformat())]),
+        ("/alerts?status=all", [], [])
+    ], ids=['open', 'all'])
+    def test_get_alerts(self, client, fake_cursor, url, rows, expected):
+        """Test that alert rows are returned as-is, with ISO timestamps."""
+        with patch('api.db.get_cursor', return_value=fake_cursor(fetchall=rows)):
+            response = client.get(url)
+        
+        assert response.status_code == 200
+        assert response.json() == expected
+    
+    def test_get_protocols(self, client, fake_cursor):
         """Test get protocols endpoint."""
-        mock_cursor_obj = MagicMock()
-        mock_cursor_obj.__enter__.return_value.fetchone.return_value = {
-            'protocol_name': 'test-protocol',
-            'tvl_usd': Decimal('1000000.00'),
-            'apy_7d': Decimal('5.25'),
-            'utilization_rate': Decimal('0.75'),
-            'timestamp': datetime.now(timezone.utc)
-        }
-        mock_cursor.return_value = mock_cursor_obj
-        
-        with patch('api.determine_protocol_status', return_value='healthy'):
+        cursor = fake_cursor(fetchall=[
+            ('test-protocol', NOW, 1000000.0, 5.25, 0.75)
+        ])
+        
+        with patch.multiple('api',
+                            db=Mock(**{'get_cursor.return_value': cursor}),
+                            determine_protocol_statuses=Mock(return_value={'test-protocol': 'healthy'})):
             response = client.get("/protocols")
         
         assert response.status_code == 200
@@ -49,85 +89,167 @@ class TestAPIEndpoints:
         assert data[0]['name'] == 'test-protocol'
         assert data[0]['status'] == 'healthy'
     
+    def test_get_protocols_without_data(self, client, fake_cursor):
+        """Test get protocols endpoint when a protocol has no snapshots."""
+        cursor = fake_cursor(fetchall=[
+            ('a', NOW, 1000000.0, 5.25, None)
+        ])
+        mock_statuses = Mock(return_value={'a': 'warning'})
+        
+        with patch.multiple('api',
+                            PROTOCOLS={'a': {}, 'b': {}},
+                            db=Mock(**{'get_cursor.return_value': cursor}),
+                            determine_protocol_statuses=mock_statuses):
+            response = client.get("/protocols")
+        
+        assert response.status_code == 200
+        data = response.json()
+        assert [p['status'] for p in data] == ['warning', 'unknown']
+        mock_statuses.assert_called_once_with(['a'])
+    
     @patch('api.db.get_cursor')
-    @patch('api.PROTOCOLS', {'test-protocol': {}})
-    def test_get_protocol_history(self, mock_cursor, client):
+    def test_get_protocols_cached(self, mock_cursor, client, fake_cursor):
+        """Test that repeated /protocols calls within the TTL reuse the result."""
+        mock_cursor.return_value = fake_cursor(fetchall=[])
+        
+        first = client.get("/protocols")
+        second = client.get("/protocols")
+        
+        assert first.json() == second.json()
+        assert mock_cursor.call_count == 1
+        assert second.headers['cache-control'].startswith('public, max-age=')
+    
+    def test_cached_protocols_single_flight(self):
+        """Test that concurrent cache misses share one load."""
+        release = threading.Event()
+        started = threading.Event()
+        
+        def slow_load():
+            started.set()
+            release.wait(5)
+            return [{'name': 'test-protocol'}]
+        
+        with patch('api._load_protocols', side_effect=slow_load) as mock_load, \
+                ThreadPoolExecutor(max_workers=4) as pool:
+            futures = [pool.submit(api._cached_protocols) for _ in range(4)]
+            assert started.wait(5)
+            release.set()
+            results = [future.result(timeout=5) for future in futures]
+        
+        assert mock_load.call_count == 1
+        assert results == [[{'name': 'test-protocol'}]] * 4
+    
+    def test_cached_protocols_serves_stale_while_loading(self):
+        """Test that an expired payload is served, without waiting, while it reloads."""
+        api._protocols_cache.update(data=[{'name': 'old'}], expires_at=0)
+        release = threading.Event()
+        started = threading.Event()
+        
+        def slow_load():
+            started.set()
+            release.wait(5)
+            return [{'name': 'new'}]
+        
+        with patch('api._load_protocols', side_effect=slow_load), \
+                ThreadPoolExecutor(max_workers=1) as pool:
+            loader = pool.submit(api._cached_protocols)
+            assert started.wait(5)
+            assert api._cached_protocols() == [{'name': 'old'}]
+            release.set()
+            assert loader.result(timeout=5) == [{'name': 'new'}]
+        
+        assert api._cached_protocols() == [{'name': 'new'}]
+    
+    @patch('api.db.get_cursor')
+    def test_determine_protocol_statuses(self, mock_cursor, fake_cursor):
+        """Test status lookup for several protocols in one query."""
+        mock_cursor.return_value = fake_cursor(fetchall=[
+            ('a', 'critical'),
+            ('b', 'info')
+        ])
+        
+        statuses = determine_protocol_statuses(['a', 'b', 'c'])
+        
+        assert statuses == {'a': 'critical', 'b': 'healthy', 'c': 'healthy'}
+    
+    @patch('api.db.get_cursor')
+    def test_get_protocol_history(self, mock_cursor, client, fake_cursor):
         """Test get protocol history endpoint."""
-        mock_cursor_obj = MagicMock()
-        mock_cursor_obj.__enter__.return_value.fetchall.return_value = [
+        mock_cursor.return_value = fake_cursor(fetchall=[
+            {
+                'timestamp': NOW,
+                'tvl': 1000000.0,
+                'apy': 5.25,
+                'utilization': 0.75
+            },
             {
-                'timestamp': datetime.now(timezone.utc),
-                'tvl_usd': Decimal('1000000.00'),
-                'apy_7d': Decimal('5.25'),
-                'utilization_rate': Decimal('0.75')
+                'timestamp': NOW,
+                'tvl': 990000.0,
+                'apy': 5.2,
+                'utilization': 0.74
             }
-        ]
-        mock_cursor.return_value = mock_cursor_obj
+        ])
         
-        response = client.get("/protocols/test-protocol/history?days=30")
+        # One row per page, so the response spans several fetchmany calls
+        with patch('api.HISTORY_FETCH_SIZE', 1):
+            response = client.get("/protocols/test-protocol/history?days=30")
         
         assert response.status_code == 200
         data = response.json()
-        assert len(data) > 0
+        assert len(data) == 2
         assert 'timestamp' in data[0]
         assert 'tvl' in data[0]
+        assert mock_cursor.call_args.kwargs['name'] == 'protocol_history'
     
-    def test_get_protocol_history_not_found(self, client):
-        """Test get protocol history for unknown protocol."""
-        response = client.get("/protocols/unknown-protocol/history")
-        assert response.status_code == 404
+    @patch('api.db.get_cursor')
+    def test_encode_history_releases_cursor(self, mock_cursor, fake_cursor):
+        """Test that the whole window is read and the cursor closed before anything is sent."""
+        cursor = fake_cursor(fetchall=[
+            {'timestamp': NOW, 'tvl': 1000000.0, 'apy': 5.25, 'utilization': 0.75}
+        ] * 3)
+        mock_cursor.return_value = cursor
+        
+        with patch('api.HISTORY_FETCH_SIZE', 2):
+            content = api._encode_history('test-protocol', 30)
+        
+        assert cursor.closed is True
+        assert len(json.loads(content)) == 3
     
     @patch('api.db.get_cursor')
-    def test_get_alerts_open(self, mock_cursor, client):
-        """Test get open alerts endpoint."""
-        mock_cursor_obj = MagicMock()
-        mock_cursor_obj.__enter__.return_value.fetchall.return_value = [
-            {
-                'id': 1,
-                'protocol_name': 'test-protocol',
-                'alert_type': 'tvl_drop',
-                'severity': 'critical',
-                'message': 'Test alert',
-                'triggered_at': datetime.now(timezone.utc),
-                'resolved_at': None
-            }
-        ]
-        mock_cursor.return_value = mock_cursor_obj
+    def test_get_protocol_history_empty(self, mock_cursor, client, fake_cursor):
+        """Test history for a protocol without snapshots."""
+        mock_cursor.return_value = fake_cursor()
         
-        response = client.get("/alerts?status=open")
+        response = client.get("/protocols/test-protocol/history")
         
         assert response.status_code == 200
-        data = response.json()
-        assert len(data) > 0
-        assert data[0]['status'] == 'open'
-        assert data[0]['severity'] == 'critical'
+        assert response.json() == []
     
     @patch('api.db.get_cursor')
-    def test_get_alerts_all(self, mock_cursor, client):
-        """Test get all alerts endpoint."""
-        mock_cursor_obj = MagicMock()
-        mock_cursor_obj.__enter__.return_value.fetchall.return_value = []
-        mock_cursor.return_value = mock_cursor_obj
+    def test_get_protocol_history_db_error(self, mock_cursor, client):
+        """Test that a failing history query returns 500."""
+        mock_cursor.return_value.__enter__.return_value.execute.side_effect = Exception('db down')
         
-        response = client.get("/alerts?status=all")
+        response = client.get("/protocols/test-protocol/history")
         
-        assert response.status_code == 200
-        data = response.json()
-        assert isinstance(data, list)
+        assert response.status_code == 500
+    
+    def test_get_protocol_history_not_found(self, client):
+        """Test get protocol history for unknown protocol."""
+        response = client.get("/protocols/unknown-protocol/history")
+        assert response.status_code == 404
     
     @patch('api.db.get_cursor')
-    def test_health_check_healthy(self, mock_cursor, client):
+    def test_health_check_healthy(self, mock_cursor, client, fake_cursor):
         """Test health check endpoint when healthy."""
-        mock_cursor_obj = MagicMock()
-        mock_cursor_obj.__enter__.return_value.execute.return_value = None
-        mock_cursor.return_value = mock_cursor_obj
+        mock_cursor.return_value = fake_cursor()
         
         response = client.get("/health")
         
         assert response.status_code == 200
         data = response.json()
         assert data['status'] == 'healthy'
-        assert 'timestamp' in data
+        assert datetime.fromisoformat(data['timestamp']).tzinfo is not None
     
     @patch('api.db.get_cursor')
     def test_health_check_unhealthy(self, mock_cursor, client):
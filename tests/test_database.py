@@ -0,0 +1,221 @@
+"""Tests for the database connection module."""
+
+import psycopg2
+import pytest
+from contextlib import ExitStack
+from datetime import datetime, timezone
+from unittest.mock import MagicMock, patch
+
+from config import DB_POOL_MIN_CONN, DB_POOL_MAX_CONN
+from database import Database, PREPARED_STATEMENTS, _PooledConnection, db
+
+NOW = datetime(2024, 1, 1, 12, 0, tzinfo=timezone.utc)
+
+
+def _connection():
+    """Mocked pooled connection with no statements prepared yet."""
+    return MagicMock(statements_prepared=False, closed=0, autocommit=False)
+
+
+def _prepare_calls(conn):
+    """SQL run on the cursor _prepare_statements opens."""
+    cursor = conn.cursor.return_value.__enter__.return_value
+    return [call.args[0] for call in cursor.execute.call_args_list]
+
+
+@pytest.fixture
+def mock_pool():
+    """Patch ThreadedConnectionPool; its instance hands out one mocked connection."""
+    with patch('database.ThreadedConnectionPool') as pool_class:
+        pool_class.return_value.getconn.return_value = _connection()
+        yield pool_class.return_value
+
+
+class TestPreparedStatements:
+    """Test cases for per-connection statement preparation."""
+    
+    def test_prepared_once_per_connection(self, mock_pool):
+        """Test that a connection is prepared on first checkout only."""
+        database = Database()
+        conn = mock_pool.getconn.return_value
+        
+        for _ in range(3):
+            with database.get_connection():
+                pass
+        
+        statements = _prepare_calls(conn)
+        assert statements[0] == "DEALLOCATE ALL"
+        assert len(statements) == len(PREPARED_STATEMENTS) + 1
+        assert all(sql.startswith('PREPARE ') for sql in statements[1:])
+        assert conn.statements_prepared is True
+        mock_pool.putconn.assert_called_with(conn, close=False)
+    
+    def test_reprepared_after_reset(self, mock_pool):
+        """Test that a connection whose flag was reset deallocates and prepares again."""
+        database = Database()
+        conn = mock_pool.getconn.return_value
+        
+        with database.get_connection():
+            pass
+        conn.statements_prepared = False
+        with database.get_connection():
+            pass
+        
+        statements = _prepare_calls(conn)
+        assert statements.count("DEALLOCATE ALL") == 2
+        assert len(statements) == 2 * (len(PREPARED_STATEMENTS) + 1)
+        assert statements[len(PREPARED_STATEMENTS) + 1] == "DEALLOCATE ALL"
+    
+    def test_failed_prepare_closes_connection(self, mock_pool):
+        """Test that a connection that could not be prepared is used once, then closed."""
+        database = Database()
+        conn = mock_pool.getconn.return_value
+        cursor = conn.cursor.return_value.__enter__.return_value
+        
+        def execute(sql):
+            if sql.startswith('PREPARE'):
+                raise psycopg2.ProgrammingError('relation "protocol_snapshots" does not exist')
+        
+        cursor.execute.side_effect = execute
+        
+        with database.get_connection() as checked_out:
+            assert checked_out is conn
+        
+        conn.rollback.assert_called_once_with()
+        assert conn.statements_prepared is False
+        mock_pool.putconn.assert_called_once_with(conn, close=True)
+    
+    def test_broken_connection_closed(self, mock_pool):
+        """Test that a connection that died during use is closed, not pooled."""
+        database = Database()
+        conn = mock_pool.getconn.return_value
+        
+        with pytest.raises(psycopg2.OperationalError):
+            with database.get_connection():
+                conn.closed = 2
+                raise psycopg2.OperationalError('server closed the connection')
+        
+        conn.rollback.assert_not_called()
+        mock_pool.putconn.assert_called_once_with(conn, close=True)
+
+
+class TestConnectionPool:
+    """Test cases for the lazy pool, its checkout limit and session()."""
+    
+    @patch('database.ThreadedConnectionPool')
+    def test_pool_created_lazily_once(self, pool_class):
+        """Test that the pool is built on first checkout and then reused."""
+        pool_class.return_value.getconn.return_value = _connection()
+        database = Database()
+        assert pool_class.call_count == 0
+        
+        for _ in range(2):
+            with database.get_connection():
+                pass
+        
+        pool_class.assert_called_once_with(
+            DB_POOL_MIN_CONN, DB_POOL_MAX_CONN,
+            dsn=database.dsn, connection_factory=_PooledConnection
+        )
+    
+    @patch('database.DB_POOL_MAX_CONN', 2)
+    def test_checkouts_limited_to_pool_size(self, mock_pool):
+        """Test that no more than DB_POOL_MAX_CONN connections are out at once."""
+        database = Database()
+        
+        with ExitStack() as stack:
+            for _ in range(2):
+                stack.enter_context(database.get_connection())
+            # A third checkout would block until one of these is released
+            assert database._pool_slots.acquire(blocking=False) is False
+        
+        assert database._pool_slots.acquire(blocking=False) is True
+        database._pool_slots.release()
+    
+    @patch('database.DB_POOL_MAX_CONN', 2)
+    def test_slot_released_on_exception(self, mock_pool):
+        """Test that a failing block rolls back and frees its connection and slot."""
+        database = Database()
+        conn = mock_pool.getconn.return_value
+        
+        for _ in range(3):
+            with pytest.raises(ValueError):
+                with database.get_connection():
+                    raise ValueError('query failed')
+        
+        assert conn.rollback.call_count == 3
+        assert mock_pool.putconn.call_count == 3
+        assert [database._pool_slots.acquire(blocking=False) for _ in range(3)] == [True, True, False]
+    
+    @patch('database.DB_POOL_MAX_CONN', 2)
+    def test_slot_released_when_pool_fails(self, mock_pool):
+        """Test that a failed getconn does not leak a slot."""
+        database = Database()
+        mock_pool.getconn.side_effect = psycopg2.OperationalError('could not connect')
+        
+        for _ in range(3):
+            with pytest.raises(psycopg2.OperationalError):
+                with database.get_connection():
+                    pass
+        
+        mock_pool.putconn.assert_not_called()
+        assert [database._pool_slots.acquire(blocking=False) for _ in range(3)] == [True, True, False]
+    
+    def test_session_autocommit_restored(self, mock_pool):
+        """Test that session() runs in autocommit and restores it, also on errors."""
+        database = Database()
+        conn = mock_pool.getconn.return_value
+        
+        with database.session() as session_conn:
+            assert session_conn.autocommit is True
+        assert conn.autocommit is False
+        
+        with pytest.raises(ValueError):
+            with database.session():
+                raise ValueError('query failed')
+        assert conn.autocommit is False
+        mock_pool.putconn.assert_called_with(conn, close=False)
+
+
+class TestBulkInsertSnapshots:
+    """Test cases for the single-statement snapshot insert."""
+    
+    ROWS = [
+        ('a', NOW, 1000000.0, 5.25, 0.75),
+        ('b', NOW, 2000000.0, 3.5, None)
+    ]
+    
+    @patch('database.db.get_cursor')
+    def test_insert_skips_existing(self, mock_cursor, fake_cursor):
+        """Test one multi-row INSERT ... DO NOTHING, mapped back via RETURNING."""
+        cursor = mock_cursor.return_value = fake_cursor(fetchall=[('a',)])
+        
+        written = db.bulk_insert_snapshots(self.ROWS)
+        
+        assert written == ['a']
+        assert len(cursor.executed) == 1
+        sql = b' '.join(cursor.executed[0][0].split())
+        assert (b"VALUES ('a', '2024-01-01 12:00:00+00:00', 1000000.0, 5.25, 0.75),"
+                b"('b', '2024-01-01 12:00:00+00:00', 2000000.0, 3.5, NULL)") in sql
+        assert sql.endswith(b"ON CONFLICT (protocol_name, timestamp) DO NOTHING RETURNING protocol_name")
+        mock_cursor.assert_called_once_with(dict_cursor=False)
+    
+    @patch('database.db.get_cursor')
+    def test_insert_update_existing(self, mock_cursor, fake_cursor):
+        """Test that update_existing overwrites the metrics of existing snapshots."""
+        cursor = mock_cursor.return_value = fake_cursor(fetchall=[('a',), ('b',)])
+        
+        written = db.bulk_insert_snapshots(self.ROWS, update_existing=True)
+        
+        assert written == ['a', 'b']
+        sql = b' '.join(cursor.executed[0][0].split())
+        assert (b"ON CONFLICT (protocol_name, timestamp) DO UPDATE SET "
+                b"tvl_usd = EXCLUDED.tvl_usd, apy_7d = EXCLUDED.apy_7d, "
+                b"utilization_rate = EXCLUDED.utilization_rate RETURNING protocol_name") in sql
+        assert b"DO NOTHING" not in sql
+    
+    @patch('database.db.get_cursor')
+    def test_insert_empty(self, mock_cursor):
+        """Test that an empty batch does not touch the database."""
+        assert db.bulk_insert_snapshots([]) == []
+        mock_cursor.assert_not_called()
@@ -1,11 +1,37 @@
 """Tests for the data ingestion module."""
 
+import asyncio
+import httpx
 import pytest
-from unittest.mock import Mock, patch, MagicMock
-from decimal import Decimal
+from unittest.mock import patch, AsyncMock
 import requests
+import responses
+from collections import namedtuple
+from functools import partial
+from types import MappingProxyType, SimpleNamespace
 
-from ingest import ProtocolDataFetcher
+from ingest import ProtocolDataFetcher, _backoff_delay
+
+TEST_URL = 'http://test.com/api'
+
+
+# Frozen stand-in for an httpx response; the fetcher only reads these fields
+_Response = namedtuple('_Response', 'status_code content headers', defaults=(b'', MappingProxyType({})))
+
+
+@pytest.fixture(scope="session")
+def http_session():
+    """One keep-alive session for every fetcher the tests build."""
+    session = requests.Session()
+    session.headers.update({'User-Agent': 'tests'})
+    yield session
+    session.close()
+
+
+@pytest.fixture(scope="module")
+def fetcher(http_session):
+    """One fetcher shared by the tests that don't inspect construction."""
+    return ProtocolDataFetcher(session=http_session)
 
 
 class TestProtocolDataFetcher:
@@ -17,134 +43,244 @@ class TestProtocolDataFetcher:
         assert fetcher.session is not None
         assert 'User-Agent' in fetcher.session.headers
     
-    @patch('ingest.requests.Session.get')
-    def test_fetch_with_retry_success(self, mock_get):
+    def test_fetchers_share_session(self):
+        """Test that fetchers reuse one pooled HTTP session."""
+        assert ProtocolDataFetcher().session is ProtocolDataFetcher().session
+    
+    def test_init_with_session(self, http_session):
+        """Test that a caller-provided session is used as-is."""
+        assert ProtocolDataFetcher(session=http_session).session is http_session
+    
+    @responses.activate
+    def test_fetch_with_retry_success(self, fetcher):
         """Test successful data fetch."""
-        mock_response = Mock()
-        mock_response.status_code = 200
-        mock_response.json.return_value = {'tvl': 1000000}
-        mock_get.return_value = mock_response
+        responses.add(responses.GET, TEST_URL, json={'tvl': 1000000}, status=200)
         
-        fetcher = ProtocolDataFetcher()
-        result = fetcher.fetch_with_retry('http://test.com/api')
+        result = fetcher.fetch_with_retry(TEST_URL)
         
         assert result == {'tvl': 1000000}
-        assert mock_get.call_count == 1
+        assert len(responses.calls) == 1
     
-    @patch('ingest.requests.Session.get')
+    @responses.activate
     @patch('ingest.time.sleep')
-    def test_fetch_with_retry_timeout(self, mock_sleep, mock_get):
+    def test_fetch_with_retry_timeout(self, mock_sleep, fetcher):
         """Test fetch with timeout and retry."""
-        mock_get.side_effect = requests.exceptions.Timeout()
+        responses.add(responses.GET, TEST_URL, body=requests.exceptions.Timeout())
         
-        fetcher = ProtocolDataFetcher()
-        result = fetcher.fetch_with_retry('http://test.com/api', max_retries=3)
+        result = fetcher.fetch_with_retry(TEST_URL, max_retries=3)
         
         assert result is None
-        assert mock_get.call_count == 3
+        assert len(responses.calls) == 3
         assert mock_sleep.call_count == 2
     
-    @patch('ingest.requests.Session.get')
+    @responses.activate
     @patch('ingest.time.sleep')
-    def test_fetch_with_retry_5xx_error(self, mock_sleep, mock_get):
+    def test_fetch_with_retry_5xx_error(self, mock_sleep, fetcher):
         """Test fetch with 5xx server error and retry."""
-        mock_response = Mock()
-        mock_response.status_code = 503
-        mock_get.return_value = mock_response
+        responses.add(responses.GET, TEST_URL, status=503)
         
-        fetcher = ProtocolDataFetcher()
-        result = fetcher.fetch_with_retry('http://test.com/api', max_retries=2)
+        result = fetcher.fetch_with_retry(TEST_URL, max_retries=2)
         
         assert result is None
-        assert mock_get.call_count == 2
+        assert len(responses.calls) == 2
     
-    @patch('ingest.requests.Session.get')
-    def test_fetch_with_retry_malformed_json(self, mock_get):
-        """Test fetch with malformed JSON response."""
-        mock_response = Mock()
-        mock_response.status_code = 200
-        mock_response.json.side_effect = ValueError("Invalid JSON")
-        mock_get.return_value = mock_response
+    @responses.activate
+    @patch('ingest.time.sleep')
+    def test_fetch_with_retry_honors_retry_after(self, mock_sleep, fetcher):
+        """Test that a 429 with Retry-After waits the advertised time."""
+        responses.add(responses.GET, TEST_URL, status=429, headers={'Retry-After': '7'})
+        responses.add(responses.GET, TEST_URL, json={'tvl': 1000000}, status=200)
         
-        fetcher = ProtocolDataFetcher()
-        result = fetcher.fetch_with_retry('http://test.com/api')
+        result = fetcher.fetch_with_retry(TEST_URL)
         
-        assert result is None
+        assert result == {'tvl': 1000000}
+        mock_sleep.assert_called_once_with(7.0)
     
-    def test_fetch_tvl_from_defillama_numeric(self):
-        """Test TVL extraction from numeric response."""
-        fetcher = ProtocolDataFetcher()
+    @responses.activate
+    @patch('ingest.time.sleep')
+    def test_fetch_with_retry_4xx_error(self, mock_sleep, fetcher):
+        """Test that a 4xx client error is not retried."""
+        responses.add(responses.GET, TEST_URL, status=404)
         
-        with patch.object(fetcher, 'fetch_with_retry', return_value=1234567.89):
-            tvl = fetcher.fetch_tvl_from_defillama('test-protocol')
-            assert tvl == Decimal('1234567.89')
-    
-    def test_fetch_tvl_from_defillama_dict(self):
-        """Test TVL extraction from dict response."""
-        fetcher = ProtocolDataFetcher()
+        result = fetcher.fetch_with_retry(TEST_URL, max_retries=3)
         
-        with patch.object(fetcher, 'fetch_with_retry', return_value={'tvl': 9876543.21}):
-            tvl = fetcher.fetch_tvl_from_defillama('test-protocol')
-            assert tvl == Decimal('9876543.21')
+        assert result is None
+        assert len(responses.calls) == 1
+        assert mock_sleep.call_count == 0
     
-    def test_fetch_tvl_from_defillama_none(self):
-        """Test TVL extraction when fetch fails."""
-        fetcher = ProtocolDataFetcher()
-        
-        with patch.object(fetcher, 'fetch_with_retry', return_value=None):
-            tvl = fetcher.fetch_tvl_from_defillama('test-protocol')
-            assert tvl is None
+    @patch('ingest.random.uniform', side_effect=lambda low, high: high)
+    def test_backoff_delay_is_capped(self, mock_uniform):
+        """Test that jittered backoff grows exponentially up to MAX_BACKOFF."""
+        assert [_backoff_delay(attempt) for attempt in range(6)] == [2, 4, 8, 16, 30, 30]
+        assert _backoff_delay(0, retry_after=120.0) == 30
     
-    def test_fetch_mock_apy(self):
-        """Test mock APY fetching."""
-        fetcher = ProtocolDataFetcher()
-        
-        apy = fetcher.fetch_mock_apy('aave-v3')
-        assert apy == Decimal('3.45')
+    @responses.activate
+    def test_fetch_with_retry_malformed_json(self, fetcher):
+        """Test fetch with malformed JSON response."""
+        responses.add(responses.GET, TEST_URL, body='<html>not json</html>', status=200)
         
-        apy = fetcher.fetch_mock_apy('compound-v3')
-        assert apy == Decimal('4.25')
+        result = fetcher.fetch_with_retry(TEST_URL)
         
-        apy = fetcher.fetch_mock_apy('unknown-protocol')
-        assert apy is None
+        assert result is None
+    
+    @pytest.mark.parametrize('response, expected', [
+        (1234567.89, 1234567.89),
+        ({'tvl': 9876543.21}, 9876543.21),
+        (None, None)
+    ], ids=['numeric', 'dict', 'none'])
+    def test_fetch_tvl_from_defillama(self, fetcher, response, expected):
+        """Test TVL extraction from numeric, dict and failed responses."""
+        with patch.object(fetcher, 'fetch_with_retry', return_value=response):
+            assert fetcher.fetch_tvl_from_defillama('test-protocol') == expected
     
-    def test_fetch_mock_utilization(self):
+    @pytest.mark.parametrize('protocol_key, expected', [
+        ('aave-v3', 3.45),
+        ('compound-v3', 4.25),
+        ('unknown-protocol', None)
+    ])
+    def test_fetch_mock_apy(self, fetcher, protocol_key, expected):
+        """Test mock APY fetching."""
+        assert fetcher.fetch_mock_apy(protocol_key) == expected
+    
+    @pytest.mark.parametrize('protocol_key, expected', [
+        ('aave-v3', 0.725),
+        ('unknown-protocol', None)
+    ])
+    def test_fetch_mock_utilization(self, fetcher, protocol_key, expected):
         """Test mock utilization fetching."""
-        fetcher = ProtocolDataFetcher()
-        
-        util = fetcher.fetch_mock_utilization('aave-v3')
-        assert util == Decimal('0.7250')
-        
-        util = fetcher.fetch_mock_utilization('unknown-protocol')
-        assert util is None
+        assert fetcher.fetch_mock_utilization(protocol_key) == expected
     
     @patch.object(ProtocolDataFetcher, 'fetch_tvl_from_defillama')
-    def test_fetch_protocol_data_success(self, mock_fetch_tvl):
+    def test_fetch_protocol_data_success(self, mock_fetch_tvl, fetcher):
         """Test successful protocol data fetching."""
-        mock_fetch_tvl.return_value = Decimal('5000000.00')
+        mock_fetch_tvl.return_value = 5000000.0
         
-        fetcher = ProtocolDataFetcher()
         data = fetcher.fetch_protocol_data('aave-v3')
         
         assert data is not None
         assert data['protocol_name'] == 'aave-v3'
-        assert data['tvl_usd'] == Decimal('5000000.00')
-        assert data['apy_7d'] == Decimal('3.45')
-        assert data['utilization_rate'] == Decimal('0.7250')
+        assert data['tvl_usd'] == 5000000.0
+        assert data['apy_7d'] == 3.45
+        assert data['utilization_rate'] == 0.725
     
     @patch.object(ProtocolDataFetcher, 'fetch_tvl_from_defillama')
-    def test_fetch_protocol_data_failure(self, mock_fetch_tvl):
+    def test_fetch_protocol_data_failure(self, mock_fetch_tvl, fetcher):
         """Test protocol data fetching when TVL fetch fails."""
         mock_fetch_tvl.return_value = None
         
-        fetcher = ProtocolDataFetcher()
         data = fetcher.fetch_protocol_data('aave-v3')
         
         assert data is None
     
-    def test_fetch_protocol_data_unknown_protocol(self):
+    def test_fetch_protocol_data_unknown_protocol(self, fetcher):
         """Test fetching data for unknown protocol."""
-        fetcher = ProtocolDataFetcher()
         data = fetcher.fetch_protocol_data('unknown-protocol')
         
         assert data is None
+    
+    def test_fetch_with_retry_async_success(self, fetcher):
+        """Test successful fetch on an httpx async client."""
+        client = SimpleNamespace(get=AsyncMock(return_value=_Response(200, b'{"tvl": 1000000}')))
+        
+        result = asyncio.run(fetcher.fetch_with_retry_async(client, 'http://test.com/api'))
+        
+        assert result == {'tvl': 1000000}
+        assert client.get.await_count == 1
+    
+    def test_fetch_with_retry_async_malformed_json(self, fetcher):
+        """Test that a malformed async response body is not retried."""
+        client = SimpleNamespace(get=AsyncMock(return_value=_Response(200, b'<html>not json</html>')))
+        
+        result = asyncio.run(fetcher.fetch_with_retry_async(client, TEST_URL))
+        
+        assert result is None
+        assert client.get.await_count == 1
+    
+    @patch('ingest.asyncio.sleep', new_callable=AsyncMock)
+    def test_fetch_with_retry_async_5xx_error(self, mock_sleep, fetcher):
+        """Test async fetch with 5xx server error and retry."""
+        client = SimpleNamespace(get=AsyncMock(return_value=_Response(503)))
+        
+        result = asyncio.run(fetcher.fetch_with_retry_async(client, 'http://test.com/api', max_retries=2))
+        
+        assert result is None
+        assert client.get.await_count == 2
+        assert mock_sleep.await_count == 1
+    
+    @patch('ingest.PROTOCOLS', {'aave-v3': {'name': 'Aave V3', 'defillama_slug': 'aave-v3', 'type': 'lending'}})
+    def test_fetch_all_protocol_data_async_follows_redirects(self, fetcher):
+        """Test that the async client follows a moved endpoint like requests does."""
+        def handler(request):
+            if request.url.path.endswith('/aave-v3'):
+                return httpx.Response(301, headers={'Location': str(request.url) + '-moved'})
+            return httpx.Response(200, json={'tvl': 5000000.0})
+        
+        client_factory = partial(httpx.AsyncClient, transport=httpx.MockTransport(handler))
+        with patch('ingest.httpx.AsyncClient', side_effect=client_factory):
+            results = asyncio.run(fetcher.fetch_all_protocol_data_async())
+        
+        assert results['aave-v3']['tvl_usd'] == 5000000.0
+    
+    @patch('ingest.PROTOCOLS', {'a': {}, 'b': {}, 'c': {}})
+    def test_fetch_all_protocol_data(self, fetcher):
+        """Test concurrent fetch where one protocol fails and one raises."""
+        timestamps = []
+        
+        async def fetch(client, protocol_key, timestamp):
+            timestamps.append(timestamp)
+            if protocol_key == 'c':
+                raise RuntimeError('boom')
+            return {'protocol_name': protocol_key} if protocol_key == 'a' else None
+        
+        with patch.object(fetcher, 'fetch_protocol_data_async', side_effect=fetch):
+            results = fetcher.fetch_all_protocol_data()
+        
+        assert results == {'a': {'protocol_name': 'a'}, 'b': None, 'c': None}
+        assert len(set(timestamps)) == 1
+    
+    @patch('ingest.PROTOCOLS', {'a': {}, 'b': {}})
+    def test_ingest_all_protocols_saves_fetched(self, fetcher):
+        """Test that only successfully fetched protocols are saved."""
+        fetched = {'a': {'protocol_name': 'a'}, 'b': None}
+        
+        with patch.object(fetcher, 'fetch_all_protocol_data_async', new=AsyncMock(return_value=fetched)), \
+                patch.object(fetcher, 'save_snapshots_batch', return_value={'a': True}) as mock_save:
+            results = fetcher.ingest_all_protocols()
+        
+        assert results == {'a': True, 'b': False}
+        mock_save.assert_called_once_with([{'protocol_name': 'a'}])
+    
+    @patch('ingest.db.bulk_insert_snapshots', return_value=['a'])
+    def test_save_snapshots_batch(self, mock_insert, sample_protocol_data, fetcher):
+        """Test that snapshots are written in one call and mapped back by protocol."""
+        snapshots = [
+            dict(sample_protocol_data, protocol_name='a'),
+            dict(sample_protocol_data, protocol_name='b')
+        ]
+        
+        results = fetcher.save_snapshots_batch(snapshots)
+        
+        assert results == {'a': True, 'b': False}
+        assert mock_insert.call_count == 1
+        rows = mock_insert.call_args.args[0]
+        assert [row[0] for row in rows] == ['a', 'b']
+        assert rows[0][2] == sample_protocol_data['tvl_usd']
+    
+    @patch('ingest.db.bulk_insert_snapshots', side_effect=Exception('db down'))
+    def test_save_snapshots_batch_failure(self, mock_insert, sample_protocol_data, fetcher):
+        """Test that a failed batch reports every snapshot as unsaved."""
+        results = fetcher.save_snapshots_batch([sample_protocol_data])
+        
+        assert results == {'test-protocol': False}
+    
+    @patch('ingest.db.get_cursor')
+    def test_save_snapshot_prepared(self, mock_cursor, sample_protocol_data, fetcher):
+        """Test that a single snapshot runs the prepared insert with a row tuple."""
+        cursor = mock_cursor.return_value.__enter__.return_value
+        cursor.rowcount = 1
+        
+        assert fetcher.save_snapshot(sample_protocol_data) is True
+        sql, params = cursor.execute.call_args.args
+        assert sql.startswith('EXECUTE insert_snapshot(')
+        assert params[0] == 'test-protocol'
+        assert params[2] == sample_protocol_data['tvl_usd']
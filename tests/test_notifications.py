@@ -1,11 +1,23 @@
 """Tests for the Slack notifications module."""
 
+import json
 import pytest
-from unittest.mock import Mock, patch
+import requests
+import responses
 from datetime import datetime, timezone
 
 from notifications import SlackNotifier
 
+NOW = datetime(2024, 1, 1, 12, 0, tzinfo=timezone.utc)
+
+WEBHOOK_URL = 'https://hooks.slack.com/test'
+
+
+@pytest.fixture(scope="module")
+def sample_alert_warning(sample_alert_data):
+    """Warning-level variant of the shared sample alert."""
+    return dict(sample_alert_data, severity='warning', alert_type='apy_low', message='APY below threshold')
+
 
 class TestSlackNotifier:
     """Test cases for SlackNotifier class."""
@@ -17,139 +29,107 @@ class TestSlackNotifier:
     
     def test_init_with_webhook(self):
         """Test initialization with webhook URL."""
-        notifier = SlackNotifier(webhook_url='https://hooks.slack.com/test')
+        notifier = SlackNotifier(webhook_url=WEBHOOK_URL)
         assert notifier.enabled is True
-        assert notifier.webhook_url == 'https://hooks.slack.com/test'
+        assert notifier.webhook_url == WEBHOOK_URL
     
-    def test_format_alert_message_critical(self):
+    def test_format_alert_message_critical(self, sample_alert_data):
         """Test formatting critical alert message."""
-        notifier = SlackNotifier(webhook_url='https://hooks.slack.com/test')
+        notifier = SlackNotifier(webhook_url=WEBHOOK_URL)
         
-        alert = {
-            'protocol_name': 'test-protocol',
-            'severity': 'critical',
-            'alert_type': 'tvl_drop',
-            'message': 'TVL dropped 25%',
-            'triggered_at': datetime.now(timezone.utc)
-        }
-        
-        message = notifier._format_alert_message(alert)
+        message = notifier._format_alert_message(sample_alert_data)
         
         assert 'attachments' in message
         assert message['attachments'][0]['color'] == '#FF0000'
         assert 'blocks' in message['attachments'][0]
     
-    def test_format_alert_message_warning(self):
+    def test_format_alert_message_warning(self, sample_alert_warning):
         """Test formatting warning alert message."""
-        notifier = SlackNotifier(webhook_url='https://hooks.slack.com/test')
-        
-        alert = {
-            'protocol_name': 'test-protocol',
-            'severity': 'warning',
-            'alert_type': 'apy_low',
-            'message': 'APY below threshold',
-            'triggered_at': datetime.now(timezone.utc)
-        }
+        notifier = SlackNotifier(webhook_url=WEBHOOK_URL)
         
-        message = notifier._format_alert_message(alert)
+        message = notifier._format_alert_message(sample_alert_warning)
         
         assert message['attachments'][0]['color'] == '#FFA500'
     
-    @patch('notifications.requests.post')
-    def test_send_alert_success(self, mock_post):
+    @responses.activate
+    def test_send_alert_success(self, sample_alert_data):
         """Test sending alert successfully."""
-        mock_response = Mock()
-        mock_response.status_code = 200
-        mock_post.return_value = mock_response
+        responses.add(responses.POST, WEBHOOK_URL, status=200)
         
-        notifier = SlackNotifier(webhook_url='https://hooks.slack.com/test')
+        notifier = SlackNotifier(webhook_url=WEBHOOK_URL)
         
-        alert = {
-            'protocol_name': 'test-protocol',
-            'severity': 'critical',
-            'alert_type': 'tvl_drop',
-            'message': 'Test alert',
-            'triggered_at': datetime.now(timezone.utc)
-        }
-        
-        result = notifier.send_alert(alert)
+        result = notifier.send_alert(sample_alert_data)
         
         assert result is True
-        assert mock_post.call_count == 1
+        assert len(responses.calls) == 1
+        
+        # Body is the formatted message, pre-encoded as JSON bytes
+        request = responses.calls[0].request
+        assert request.headers['Content-Type'] == 'application/json'
+        assert json.loads(request.body) == notifier._format_alert_message(sample_alert_data)
     
-    @patch('notifications.requests.post')
-    def test_send_alert_failure(self, mock_post):
-        """Test sending alert with failure."""
-        mock_response = Mock()
-        mock_response.status_code = 400
-        mock_response.text = 'Bad request'
-        mock_post.return_value = mock_response
+    @responses.activate
+    def test_send_alerts_batches_attachments(self):
+        """Test that many alerts share posts, up to Slack's attachment limit each."""
+        responses.add(responses.POST, WEBHOOK_URL, status=200)
         
-        notifier = SlackNotifier(webhook_url='https://hooks.slack.com/test')
+        notifier = SlackNotifier(webhook_url=WEBHOOK_URL)
         
-        alert = {
-            'protocol_name': 'test-protocol',
-            'severity': 'critical',
-            'alert_type': 'tvl_drop',
-            'message': 'Test alert',
-            'triggered_at': datetime.now(timezone.utc)
-        }
+        alerts = [{
+            'protocol_name': f'protocol-{i}',
+            'severity': 'warning',
+            'alert_type': 'apy_low',
+            'message': 'APY below threshold',
+            'triggered_at': NOW
+        } for i in range(51)]
         
-        result = notifier.send_alert(alert)
+        result = notifier.send_alerts(alerts)
         
-        assert result is False
+        assert result is True
+        assert len(responses.calls) == 2
+        sizes = [len(json.loads(call.request.body)['attachments']) for call in responses.calls]
+        assert sizes == [50, 1]
     
-    def test_send_alert_disabled(self):
-        """Test sending alert when notifications disabled."""
-        notifier = SlackNotifier(webhook_url=None)
+    @responses.activate
+    def test_send_alert_failure(self, sample_alert_data):
+        """Test sending alert with failure."""
+        responses.add(responses.POST, WEBHOOK_URL, status=400, body='Bad request')
         
-        alert = {
-            'protocol_name': 'test-protocol',
-            'severity': 'critical',
-            'alert_type': 'tvl_drop',
-            'message': 'Test alert',
-            'triggered_at': datetime.now(timezone.utc)
-        }
+        notifier = SlackNotifier(webhook_url=WEBHOOK_URL)
         
-        result = notifier.send_alert(alert)
+        result = notifier.send_alert(sample_alert_data)
         
         assert result is False
     
-    @patch('notifications.requests.post')
-    def test_send_test_message_success(self, mock_post):
+    @pytest.mark.parametrize('method, args', [
+        ('send_alert', ({},)),
+        ('send_alerts', ([{}],)),
+        ('send_test_message', ())
+    ])
+    def test_send_disabled(self, method, args):
+        """Test that every send path returns False when notifications are disabled."""
+        notifier = SlackNotifier(webhook_url=None)
+        
+        assert getattr(notifier, method)(*args) is False
+    
+    @responses.activate
+    def test_send_test_message_success(self):
         """Test sending test message successfully."""
-        mock_response = Mock()
-        mock_response.status_code = 200
-        mock_post.return_value = mock_response
+        responses.add(responses.POST, WEBHOOK_URL, status=200)
         
-        notifier = SlackNotifier(webhook_url='https://hooks.slack.com/test')
+        notifier = SlackNotifier(webhook_url=WEBHOOK_URL)
         result = notifier.send_test_message()
         
         assert result is True
-        assert mock_post.call_count == 1
+        assert len(responses.calls) == 1
     
-    def test_send_test_message_disabled(self):
-        """Test sending test message when disabled."""
-        notifier = SlackNotifier(webhook_url=None)
-        result = notifier.send_test_message()
-        
-        assert result is False
-    
-    @patch('notifications.requests.post')
-    def test_send_alert_exception(self, mock_post):
+    @responses.activate
+    def test_send_alert_exception(self, sample_alert_data):
         """Test sending alert with exception."""
-        mock_post.side_effect = Exception("Network error")
-        
-        notifier = SlackNotifier(webhook_url='https://hooks.slack.com/test')
+        responses.add(responses.POST, WEBHOOK_URL, body=requests.exceptions.ConnectionError("Network error"))
         
-        alert = {
-            'protocol_name': 'test-protocol',
-            'severity': 'critical',
-            'alert_type': 'tvl_drop',
-            'message': 'Test alert',
-            'triggered_at': datetime.now(timezone.utc)
-        }
+        notifier = SlackNotifier(webhook_url=WEBHOOK_URL)
         
-        result = notifier.send_alert(alert)
+        result = notifier.send_alert(sample_alert_data)
         
         assert result is False
@@ -0,0 +1,116 @@
+"""Tests for the monitoring pipeline orchestrator."""
+
+import pytest
+from unittest.mock import Mock, patch
+from datetime import datetime, timedelta, timezone
+
+from pipeline import MonitoringPipeline
+
+NOW = datetime(2024, 1, 1, 12, 0, tzinfo=timezone.utc)
+
+PROTOCOL_KEYS = ('a', 'b', 'c')
+
+
+def _snapshot_data(protocol_name, timestamp=NOW):
+    """Fetched snapshot with metrics that raise no alerts."""
+    return {
+        'protocol_name': protocol_name,
+        'timestamp': timestamp,
+        'tvl_usd': 1000000.0,
+        'apy_7d': 5.0,
+        'utilization_rate': 0.5
+    }
+
+
+@pytest.fixture
+def pipeline():
+    """Pipeline over three protocols with a mocked fetcher and no database."""
+    with patch('pipeline._PROTOCOL_KEYS', PROTOCOL_KEYS), \
+            patch('anomaly_detector.db.get_cursor') as mock_cursor:
+        # Warm-starts find no history
+        mock_cursor.return_value.__enter__.return_value.fetchall.return_value = []
+        monitoring_pipeline = MonitoringPipeline()
+        monitoring_pipeline.fetcher = Mock()
+        yield monitoring_pipeline
+
+
+class TestMonitoringPipeline:
+    """Test cases for MonitoringPipeline class."""
+    
+    def test_run_ingestion_skips_unsaved(self, pipeline):
+        """Test that only saved snapshots are reported and checked on ingest."""
+        pipeline.fetcher.fetch_all_protocol_data.return_value = {
+            'a': _snapshot_data('a'),
+            'b': _snapshot_data('b'),
+            'c': None
+        }
+        pipeline.fetcher.save_snapshots_batch.return_value = {'a': True, 'b': False}
+        
+        with patch.object(pipeline.streaming_detector, 'update', return_value=[]) as mock_update:
+            results = pipeline.run_ingestion(NOW)
+        
+        assert results == {'a': True, 'b': False, 'c': False}
+        saved_batch = pipeline.fetcher.save_snapshots_batch.call_args.args[0]
+        assert [data['protocol_name'] for data in saved_batch] == ['a', 'b']
+        assert [call.args[0].protocol_name for call in mock_update.call_args_list] == ['a']
+        assert list(pipeline.ingest_alerts) == ['a']
+    
+    def test_run_ingestion_warm_starts_once(self, pipeline):
+        """Test that each protocol's window is loaded once, in one batch, across runs."""
+        streaming_detector = pipeline.streaming_detector
+        
+        with patch.object(streaming_detector, 'warm_start', wraps=streaming_detector.warm_start) as mock_warm_start:
+            for timestamp in (NOW, NOW + timedelta(hours=1)):
+                pipeline.fetcher.fetch_all_protocol_data.return_value = {
+                    name: _snapshot_data(name, timestamp) for name in PROTOCOL_KEYS
+                }
+                pipeline.fetcher.save_snapshots_batch.return_value = dict.fromkeys(PROTOCOL_KEYS, True)
+                
+                assert all(pipeline.run_ingestion(timestamp).values())
+        
+        mock_warm_start.assert_called_once_with(list(PROTOCOL_KEYS), before=NOW)
+    
+    def test_run_flushes_once(self, pipeline):
+        """Test that a run saves queued alerts and sends notifications exactly once."""
+        pipeline.fetcher.fetch_all_protocol_data.return_value = {
+            'a': _snapshot_data('a'),
+            'b': _snapshot_data('b'),
+            'c': None
+        }
+        pipeline.fetcher.save_snapshots_batch.return_value = {'a': True, 'b': True}
+        
+        with patch.object(pipeline.streaming_detector, 'flush') as mock_flush, \
+                patch.object(pipeline.detector, 'flush_notifications') as mock_notify, \
+                patch.object(pipeline.detector, 'get_snapshots_batch', return_value={}) as mock_batch, \
+                patch.object(pipeline.detector, 'detect_anomalies_batch', return_value={'c': []}):
+            summary = pipeline.run()
+        
+        assert summary['status'] == 'success'
+        assert summary['anomaly_results'] == {'a': 0, 'b': 0, 'c': 0}
+        # Only the protocol not checked on ingest is read back from the database
+        mock_batch.assert_called_once_with(['c'])
+        mock_flush.assert_called_once_with()
+        mock_notify.assert_called_once_with()
+    
+    def test_run_does_not_reuse_previous_ingest_alerts(self, pipeline):
+        """Test that a protocol failing in a later run is checked from the database, not with old alerts."""
+        low_apy = dict(_snapshot_data('a'), apy_7d=1.0)
+        pipeline.fetcher.fetch_all_protocol_data.return_value = {'a': low_apy, 'b': None, 'c': None}
+        pipeline.fetcher.save_snapshots_batch.return_value = {'a': True}
+        
+        with patch.object(pipeline.detector, 'save_alert', return_value=True), \
+                patch.object(pipeline.detector, 'flush_notifications'), \
+                patch.object(pipeline.detector, 'get_snapshots_batch', return_value={}) as mock_batch, \
+                patch.object(pipeline.detector, 'detect_anomalies_batch',
+                             side_effect=lambda snapshots, names: {name: [] for name in names}):
+            first = pipeline.run()
+            
+            # Second run: the fetch for 'a' fails
+            pipeline.fetcher.fetch_all_protocol_data.return_value = {'a': None, 'b': None, 'c': None}
+            pipeline.fetcher.save_snapshots_batch.return_value = {}
+            second = pipeline.run()
+        
+        assert first['anomaly_results']['a'] == 1
+        assert second['anomaly_results'] == {'a': 0, 'b': 0, 'c': 0}
+        assert pipeline.ingest_alerts == {}
+        assert mock_batch.call_args_list[-1].args == (['a', 'b', 'c'],)